@@ -1,16 +1,35 @@
 import os
 import numpy as np
-import pandas as pd
 import tkinter as tk
 from tkinter import filedialog, scrolledtext
 from tkinter.messagebox import askyesno
 from PIL import Image, ImageTk
 from sarpy.geometry import point_projection
-from sarpy.io.complex.sicd import SICDReader
 from sarpy.visualization.remap import Density
-from sarpy.utils import chip_sicd
+from image_sources import load_image
+from prefetch import ImagePrefetcher
+from image_cache import ImageCache
+from remap_cache import RemapDiskCache
+from annotation_store import AnnotationStore
+from annotations import Annotations, read_yolo, write_yolo_file, yolo_path
+from directory_index import DirectoryIndex
+from chip_export import grid_plan, export_grid, write_box_chips
+from chip_archive import shard_dir
+from export_writer import ExportWriter
+from instrumentation import probe
+from canvas_tiles import CanvasTiles
 
 remap = Density()
+IMAGE_CACHE_BYTES = 2 << 30  # budget for decoded images shared by navigation, prefetch and chipping
+REMAP_CACHE_DIR = None  # directory for memory-mapped SICD remaps reused across sessions, None disables it
+PICTURE_CACHE_DIR = None  # directory for previews and memory-mapped rasters of large JPEG/PNGs, None keeps them in memory
+CHIP_WORKERS = None  # processes used by Export Chip Grid, None sizes the pool to the grid, one process for small ones
+NPY_CHIP_KIND = 'complex'  # what Chip to NPY saves of a SICD, 'complex' samples or detected 'amplitude'
+FRAME_MS = 16  # at most one redraw per frame while panning or zooming
+REFINE_MS = 150  # input idle time before the fast preview is redrawn at full quality
+PROFILE = False  # start with stage timings on, they can also be switched on from the Profile menu
+MAX_DRAWN_SHAPES = 2000  # more visible shapes than this are shown as a density overlay instead of canvas items
+OVERLAY_CELL = 6  # screen pixels per density overlay cell
 
 class VisionLabelApp:
     def __init__(self, root):
@@ -20,12 +39,30 @@ class VisionLabelApp:
         self.image_label.pack()  # Remove this line
         self.current_image_index = None
         self.image_paths = []
+        self.dir_index = None  # index of the opened directory, None when files were picked individually
+        self.dir_indexes = {}
+        self.direction = 1
+        self.annotation_stores = {}
+        self.remap_cache = RemapDiskCache(REMAP_CACHE_DIR) if REMAP_CACHE_DIR else None
+        self.image_cache = ImageCache(lambda file_path: load_image(file_path, remap, self.remap_cache, PICTURE_CACHE_DIR), max_bytes=IMAGE_CACHE_BYTES)
+        self.prefetcher = ImagePrefetcher(self.image_cache.get)
+        # exports on image change are written in the background from a snapshot of the shapes
+        self.writer = ExportWriter()
 
         menu_bar = tk.Menu(root)
         file_menu = tk.Menu(menu_bar, tearoff=0)
         file_menu.add_command(label="Open Image", command=self.open_image)
+        file_menu.add_command(label="Write Shapes CSV", command=self.write_csv)
+        file_menu.add_command(label="Write YOLO Labels", command=self.write_yolo)
         file_menu.add_command(label="Exit", command=root.quit)
         menu_bar.add_cascade(label="File", menu=file_menu)
+        probe.enabled = PROFILE
+        self.show_timings = tk.BooleanVar(value=PROFILE)
+        profile_menu = tk.Menu(menu_bar, tearoff=0)
+        profile_menu.add_checkbutton(label="Show Timings", variable=self.show_timings, command=self.toggle_timings)
+        profile_menu.add_command(label="Reset Timings", command=probe.reset)
+        profile_menu.add_command(label="Dump Trace", command=self.dump_trace)
+        menu_bar.add_cascade(label="Profile", menu=profile_menu)
         root.config(menu=menu_bar)
 
         # Add label for displaying file name
@@ -76,6 +113,12 @@ class VisionLabelApp:
         self.chip_png_box.pack(side=tk.TOP)
         self.chip_sicd_box = tk.Checkbutton(chip_options_frame, variable=self.chip_sicd_var, text="Chip to SICD", onvalue=1, offvalue=0)
         self.chip_sicd_box.pack(side=tk.BOTTOM)
+        self.chip_npy_var = tk.IntVar()
+        self.chip_npy_box = tk.Checkbutton(chip_options_frame, variable=self.chip_npy_var, text="Chip to NPY", onvalue=1, offvalue=0)
+        self.chip_npy_box.pack(side=tk.BOTTOM)
+        self.chip_shard_var = tk.IntVar()
+        self.chip_shard_box = tk.Checkbutton(chip_options_frame, variable=self.chip_shard_var, text="Chip to Shards", onvalue=1, offvalue=0)
+        self.chip_shard_box.pack(side=tk.BOTTOM)
         
 
         check_box_frame = tk.Frame(top_frame)
@@ -100,6 +143,7 @@ class VisionLabelApp:
 
         self.canvas = tk.Canvas(self.root, bg="black")
         self.canvas.pack(fill=tk.BOTH, expand=tk.YES)
+        self.tiles = CanvasTiles(self.canvas)
 
         # Bind events for zooming and panning
         # self.canvas.bind("<MouseWheel>", self.zoom)
@@ -132,16 +176,24 @@ class VisionLabelApp:
         # Initialize image and image ID
         self.image = None
         self.image_id = None
+        self.container = None
 
         # Rectangle drawing variables
         self.csv = None
         self.rect = None
         self.start_x = None
         self.start_y = None
-        # List to keep track of drawn rectangles
-        self.shapes = []
-        self.shape_type = []
-        self.indexes = []
+        # Shapes of the current image in image coordinates, canvas items are only a view of them
+        self.annotations = Annotations()
+        self.shape_index = None
+        self.drawn_at = None  # (zoom, container origin) the drawn canvas items were placed at
+        self.render_job = None
+        self.refine_job = None
+        self.full_res_job = None
+        self.overlay_tk = None
+        self.timings_job = None
+        if PROFILE:
+            self.timings_job = self.root.after(500, self.draw_timings)
 
     def num_key(self, event):
         if 'entry' in str(self.root.focus_get()):
@@ -152,103 +204,49 @@ class VisionLabelApp:
     def class_label_down(self, event):
         self.txt.set(int(self.txt.get())-1)
 
-    def get_shape_coords(self, shape):
-        w, h = self.image.width, self.image.height
-        # print(w, h)
-        x, y = self.canvas.coords(self.container)[0], self.canvas.coords(self.container)[1]
-        x1,y1,x2,y2 = self.canvas.coords(shape)
-        coords = np.array([x1-x, y1-y, x2-x, y2-y])/self.imscale
-        coords[0] = np.max([0, coords[0]])
-        coords[1] = np.max([0, coords[1]])
-        coords[2] = np.min([w, coords[2]])
-        coords[3] = np.min([h, coords[3]])
-        return coords
+    def current_image(self):
+        ''' (image, sicd, pyramid) of the current file from the shared image cache '''
+        return self.prefetcher.get(self.image_paths[self.current_image_index])
+
+    def to_image(self, x, y):
+        ''' Canvas to image pixel coordinates '''
+        origin_x, origin_y = self.canvas.coords(self.container)[:2]
+        return (x - origin_x) / self.imscale, (y - origin_y) / self.imscale
+
+    def to_canvas(self, coords):
+        ''' (n, 4) image pixel coordinates to canvas coordinates '''
+        origin_x, origin_y = self.canvas.coords(self.container)[:2]
+        return np.asarray(coords) * self.imscale + [origin_x, origin_y, origin_x, origin_y]
 
     
+    @probe.timed('chip')
     def chip(self):
-        for i, shape in enumerate(self.shapes):
-            if self.shape_type[i] == 0:
-                shape_coords = self.get_shape_coords(shape)
-                file_path = self.image_paths[self.current_image_index]
-                dir_path = os.path.dirname(file_path)
-                file_name = os.path.basename(file_path)
-                if self.chip_png_var.get():
-                    os.makedirs(f"{dir_path}/pngs", exist_ok=True)
-                    cropped_image = self.image.crop(shape_coords)
-                    shape_coords = [int(i) for i in shape_coords]
-                    cropped_image.save(f"{dir_path}/pngs/{file_name.split('.')[0]}_{shape_coords[0]}-{shape_coords[2]}_{shape_coords[1]}-{shape_coords[3]}.png")
-                    # os.rename(f"{dir_path}/pngs/{file_name.split('.')[0]}.png",f"{dir_path}/pngs/{file_name.split('.')[0]}{i}.png")
-                if self.chip_sicd_var.get():
-                    os.makedirs(f"{dir_path}/sicds", exist_ok=True)
-                    chip_sicd.create_chip(self.sicd, out_directory=f"{dir_path}/sicds", 
-                                          row_limits=[shape_coords[0],shape_coords[2]], col_limits=[shape_coords[1], shape_coords[3]], check_existence=False)
+        image = self.current_image()[0]
+        file_path = self.image_paths[self.current_image_index]
+        boxes = self.annotations.box_rows(image.width, image.height)[1]
+        # no reader, the job opens its own instead of sharing the cached one with the Tk and prefetch threads
+        self.writer.submit(file_path, probe.wrap('chip write', write_box_chips), image, None, file_path, boxes,
+                           png=self.chip_png_var.get(), sicd=self.chip_sicd_var.get(), shard_dir=self.chip_shards(file_path),
+                           npy=self.chip_npy_var.get(), npy_kind=NPY_CHIP_KIND)
+
+    def chip_shards(self, file_path):
+        ''' Where chips of file_path are sharded when Chip to Shards is ticked, else None for one file per chip '''
+        return shard_dir(file_path) if self.chip_shard_var.get() else None
     
+    @probe.timed('grid_chip')
     def grid_chip(self):
-        grid_size = self.grid_chip_size.get()
-        w, h = self.image.width, self.image.height
-        sub_grid = grid_size//2
-        w_, h_ = w//sub_grid, h//sub_grid
+        image = self.current_image()[0]
         file_path = self.image_paths[self.current_image_index]
-        dir_path = os.path.dirname(file_path)
-        file_name = os.path.basename(file_path)
-        if self.chip_png_var.get():
-            os.makedirs(f"{dir_path}/{file_name}_png_grid")
-        if self.chip_sicd_var.get():
-            os.makedirs(f"{dir_path}/{file_name}_sicd_grid")
-        for j in range(h_-1):
-            for i in range(w_-1):
-                left = i*sub_grid
-                upper =j*sub_grid
-                right = left+grid_size
-                lower = upper+grid_size
-                if self.chip_png_var.get():
-                    cropped_image = self.image.crop((left, upper, right, lower))
-                    cropped_image.save(f"{dir_path}/{file_name}_png_grid/{file_name.split('.')[0]}_{j}_{i}.png")
-                    # cropped_image.save(f"{dir_path}/{file_name}_png_grid/{file_name.split('.')[0]}_{left}-{right}_{upper}-{lower}.png")
-                if self.chip_sicd_var.get():
-                    chip_sicd.create_chip(self.sicd, output_file=f"{dir_path}/{file_name}_sicd_grid/{file_name.split('.')[0]}_{j}_{i}.nitf",
-                                            row_limits=[left,right], col_limits=[upper, lower], check_existence=False)
-        if w%sub_grid != 0:
-            right = w
-            left = right-grid_size
-            i+=1
-            for j in range(h_-1):
-                upper =j*sub_grid
-                lower = upper+grid_size
-                if self.chip_png_var.get():
-                    cropped_image = self.image.crop((left, upper, right, lower))
-                    cropped_image.save(f"{dir_path}/{file_name}_png_grid/{file_name.split('.')[0]}_{j}_{i}.png")
-                    # cropped_image.save(f"{dir_path}/{file_name}_grid/{file_name.split('.')[0]}_{left}-{right}_{upper}-{lower}.png")
-                if self.chip_sicd_var.get():
-                    chip_sicd.create_chip(self.sicd, output_file=f"{dir_path}/{file_name}_sicd_grid/{file_name.split('.')[0]}_{j}_{i}.nitf",
-                                            row_limits=[left,right], col_limits=[upper, lower], check_existence=False)
-        if h%sub_grid!= 0:
-            lower = h
-            upper =lower-grid_size
-            j+=1
-            for i in range(w_-1):
-                left = i*sub_grid
-                right = left+grid_size
-                if self.chip_png_var.get():
-                    cropped_image = self.image.crop((left, upper, right, lower))
-                    cropped_image.save(f"{dir_path}/{file_name}_png_grid/{file_name.split('.')[0]}_{j}_{i}.png")
-                    # cropped_image.save(f"{dir_path}/{file_name}_grid/{file_name.split('.')[0]}_{left}-{right}_{upper}-{lower}.png")
-                if self.chip_sicd_var.get():
-                    chip_sicd.create_chip(self.sicd, output_file=f"{dir_path}/{file_name}_sicd_grid/{file_name.split('.')[0]}_{j}_{i}.nitf",
-                                            row_limits=[left,right], col_limits=[upper, lower], check_existence=False)
-        if (h%sub_grid!= 0) and (w%sub_grid != 0):
-            right=w
-            lower=h
-            left = right-grid_size
-            upper =lower-grid_size
-            i+=1
-            if self.chip_png_var.get():
-                cropped_image = self.image.crop((left, upper, right, lower))
-                cropped_image.save(f"{dir_path}/{file_name}_png_grid/{file_name.split('.')[0]}_{j}_{i}.png")
-                # cropped_image.save(f"{dir_path}/{file_name}_grid/{file_name.split('.')[0]}_{left}-{right}_{upper}-{lower}.png")
-            if self.chip_sicd_var.get():
-                chip_sicd.create_chip(self.sicd, output_file=f"{dir_path}/{file_name}_sicd_grid/{file_name.split('.')[0]}_{j}_{i}.nitf",
-                                        row_limits=[left,right], col_limits=[upper, lower], check_existence=False)
+        # lay out every tile first, then encode and write them off the Tk thread
+        plan = grid_plan(image.width, image.height, self.grid_chip_size.get())
+        if not plan:
+            print("Image is smaller than one grid chip")
+            return
+        self.writer.submit(file_path, probe.wrap('grid_chip write', export_grid), file_path, plan,
+                           png=self.chip_png_var.get(), sicd=self.chip_sicd_var.get(),
+                           remap=remap, data_mean=getattr(image, 'data_mean', None), workers=CHIP_WORKERS,
+                           picture_cache_dir=PICTURE_CACHE_DIR, shard_dir=self.chip_shards(file_path),
+                           npy=self.chip_npy_var.get(), npy_kind=NPY_CHIP_KIND)
 
 
     def wheel(self, event):
@@ -270,12 +268,30 @@ class VisionLabelApp:
             if i < self.imscale: return  # 1 pixel is bigger than the visible area
             self.imscale *= self.delta
             scale        *= self.delta
-        self.canvas.scale('all', x, y, scale, scale)  # rescale all canvas objects
-        self.update_image()
+        # only the image container is scaled, shapes are redrawn from image coordinates for the new view
+        self.canvas.scale(self.container, x, y, scale, scale)
+        self.request_render()
         
     
-    def update_image(self, event=None):
-        ''' Show image on the Canvas '''
+    def request_render(self):
+        ''' Coalesce pan and zoom events into one fast redraw per frame, refined once input stops '''
+        if self.render_job is None:
+            self.render_job = self.root.after(FRAME_MS, self.render_frame)
+        if self.refine_job is not None:
+            self.root.after_cancel(self.refine_job)
+        self.refine_job = self.root.after(REFINE_MS, self.refine)
+
+    def render_frame(self):
+        self.render_job = None
+        self.update_image(fast=True)
+
+    def refine(self):
+        self.refine_job = None
+        self.update_image()
+
+    @probe.timed('update_image')
+    def update_image(self, event=None, fast=False):
+        ''' Show image on the Canvas, fast is the low-detail preview drawn while panning or zooming '''
         bbox1 = self.canvas.bbox(self.container)  # get image area
         # Remove 1 pixel shift at the sides of the bbox1
         bbox1 = (bbox1[0] + 1, bbox1[1] + 1, bbox1[2] - 1, bbox1[3] - 1)
@@ -297,50 +313,134 @@ class VisionLabelApp:
         x2 = min(bbox2[2], bbox1[2]) - bbox1[0]
         y2 = min(bbox2[3], bbox1[3]) - bbox1[1]
         if int(x2 - x1) > 0 and int(y2 - y1) > 0:  # show image if it in the visible area
-            x = min(int(x2 / self.imscale), self.width)   # sometimes it is larger on 1 pixel...
-            y = min(int(y2 / self.imscale), self.height)  # ...and sometimes not
-            image = self.image.crop((int(x1 / self.imscale), int(y1 / self.imscale), x, y))
-            imagetk = ImageTk.PhotoImage(image.resize((int(x2 - x1), int(y2 - y1))))
-            imageid = self.canvas.create_image(max(bbox2[0], bbox1[0]), max(bbox2[1], bbox1[1]),
-                                               anchor='nw', image=imagetk)
-            self.canvas.lower(imageid)  # set image into background
-            self.canvas.imagetk = imagetk  # keep an extra reference to prevent garbage-collection
+            # only tiles not cached at this zoom are sampled from the pyramid and converted to PhotoImages
+            with probe.stage('tiles'):
+                self.tiles.render(self.pyramid, self.imscale, self.canvas.coords(self.container)[:2], bbox2,
+                                  (self.width, self.height), fast=fast)
+            if getattr(self.image, 'loading', False) and self.full_res_job is None:
+                # zoomed past a picture preview, redraw once full resolution has decoded
+                self.full_res_job = self.root.after(100, self.poll_full_res, self.image)
+        with probe.stage('annotations'):
+            self.draw_annotations()
+
+    def poll_full_res(self, image):
+        self.full_res_job = None
+        if image is not self.image:
+            return
+        if image.ready:
+            self.tiles.reset()  # drop the tiles upsampled from the preview
+            self.update_image()
+        else:
+            self.full_res_job = self.root.after(100, self.poll_full_res, image)
+
+    def view_bounds(self):
+        ''' The visible part of the canvas in image coordinates '''
+        x1, y1 = self.to_image(self.canvas.canvasx(0), self.canvas.canvasy(0))
+        x2, y2 = self.to_image(self.canvas.canvasx(self.canvas.winfo_width()), self.canvas.canvasy(self.canvas.winfo_height()))
+        return x1, y1, x2, y2
+
+    def draw_shape(self, index):
+        coords = self.to_canvas(self.annotations.coords[index])
+        if self.annotations.types[index] == 0:
+            return self.canvas.create_rectangle(*coords, fill="", outline="red", tags="shape")
+        return self.canvas.create_line(*coords, fill='red', width=3, tags="shape")
+
+    def draw_annotations(self):
+        ''' Keep canvas items only for shapes in view, or a density overlay when too many are visible '''
+        annotations = self.annotations
+        self.canvas.delete("overlay")
+        if not len(annotations):
+            return
+        bounds = self.view_bounds()
+        visible = annotations.in_view(bounds)
+        lod = np.count_nonzero(visible) > MAX_DRAWN_SHAPES
+        if lod:
+            visible[:] = False
+        if self.shape_index is not None:
+            visible[self.shape_index] = True  # never cull the shape being drawn
+        items = annotations.items[:len(annotations)]
+        drawn = items >= 0
+        stale = drawn & ~visible
+        if stale.any():
+            self.canvas.delete(*items[stale].tolist())
+            items[stale] = -1
+        # wheel zoom scales about the cursor, so it moves the container origin as well as the scale
+        placement = (self.imscale, tuple(self.canvas.coords(self.container)[:2]))
+        if self.drawn_at != placement:
+            # zoom moved every kept item, place them again from image coordinates
+            for index in np.flatnonzero(items >= 0):
+                self.canvas.coords(int(items[index]), *self.to_canvas(annotations.coords[index]))
+            self.drawn_at = placement
+        if lod:
+            self.draw_overlay(bounds)
+            return
+        for index in np.flatnonzero(visible & (items < 0)):
+            items[index] = self.draw_shape(index)
+
+    def draw_overlay(self, bounds):
+        ''' One image of shape counts per screen cell, cost bounded by the canvas size rather than the shape count '''
+        width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        shape = (max(1, height // OVERLAY_CELL), max(1, width // OVERLAY_CELL))
+        counts = self.annotations.density(bounds, shape)
+        alpha = np.zeros(shape, dtype=np.uint8)
+        alpha[counts > 0] = np.clip(96 + 32 * np.log2(counts[counts > 0]), 0, 255)
+        overlay = np.zeros(shape + (4,), dtype=np.uint8)
+        overlay[..., 0] = 255
+        overlay[..., 3] = alpha
+        image = Image.fromarray(overlay, 'RGBA').resize((shape[1] * OVERLAY_CELL, shape[0] * OVERLAY_CELL), Image.NEAREST)
+        self.overlay_tk = ImageTk.PhotoImage(image)
+        self.canvas.create_image(self.canvas.canvasx(0), self.canvas.canvasy(0), anchor='nw', image=self.overlay_tk, tags="overlay")
 
 
     def open_image(self):
         self.clear_rect()
         file_paths = filedialog.askopenfilenames(filetypes=[("SAR Images", "*.ntf *.nitf"), ("Pictures", "*.jpg *.jpeg *.png")])
         if len(file_paths) >1:
+            self.dir_index = None
             self.image_paths = list(file_paths)
             self.current_image_index = 0
             self.show_current_image()
         elif len(file_paths) ==1:
             self.directory = os.path.dirname(file_paths[0])
-            file_type = file_paths[0].split('.')[-1]
-            self.image_paths = [f"{self.directory}/{file}" for file in os.listdir(self.directory) if os.path.isfile(os.path.join(self.directory, file)) and file.endswith(file_type)]
-            self.current_image_index = self.image_paths.index(file_paths[0])
+            file_type = os.path.splitext(file_paths[0])[1]
+            # scanned once per directory, reopening only rescans when the directory changed
+            key = (self.directory, file_type)
+            if key in self.dir_indexes:
+                self.dir_indexes[key].refresh()
+            else:
+                self.dir_indexes[key] = DirectoryIndex(self.directory, file_type)
+            self.dir_index = self.dir_indexes[key]
+            self.image_paths = self.dir_index.paths
+            file_path = self.dir_index.path(os.path.basename(file_paths[0]))
+            self.dir_index.add(file_path)
+            self.current_image_index = self.dir_index.position(file_path)
             self.show_current_image()
 
 
+    @probe.timed('show_current_image')
     def show_current_image(self):
         if self.current_image_index is not None:
 
             file_path = self.image_paths[self.current_image_index]
+            # neighbours are decoded in the background, so this is usually already done
+            with probe.stage('load'):
+                image, sicd, pyramid = self.prefetcher.get(file_path)
             if file_path.endswith(('.ntf', '.nitf')):
-                self.sicd = SICDReader(file_path)
-                sar_image = self.sicd[:]
-                self.image = Image.fromarray(remap(sar_image))
+                self.sicd = sicd
+                self.image = image
                 self.chip_sicd_box.config(state=tk.NORMAL)
             elif file_path.endswith((".jpg", ".jpeg", ".png")):
-                self.image = Image.open(file_path)
+                self.image = image
                 self.chip_sicd_var.set(0)
                 self.chip_sicd_box.config(state=tk.DISABLED)
+            self.prefetcher.schedule(self.image_paths, self.current_image_index, self.direction)
             
 
             # Calculate initial zoom level to fit the entire image in the canvas
             canvas_width = self.canvas.winfo_width()
             canvas_height = self.canvas.winfo_height()
             self.width, self.height = self.image.size
+            self.pyramid = pyramid
             zoom_level = np.min([canvas_width/self.width, canvas_height/self.height])
 
             # self.image_tk = ImageTk.PhotoImage(self.image.resize((int(self.width * self.imscale),
@@ -348,6 +448,9 @@ class VisionLabelApp:
             self.imscale = 1.0  # scale for the canvaas image
             self.delta = 1.3  # zoom magnitude
             # Put image into container rectangle and use it to set proper coordinates to the image
+            self.tiles.reset()
+            if self.container is not None:
+                self.canvas.delete(self.container)
             self.container = self.canvas.create_rectangle(0, 0, self.width, self.height, width=0)
             self.bbox = self.canvas.bbox(self.container)
 
@@ -362,16 +465,18 @@ class VisionLabelApp:
             self.text_box.insert('1.0', f"{file_path}\n", "center")
             self.text_box.tag_configure("center", justify="center")
 
+    @probe.timed('image_change')
     def image_change(self, increment):
         if self.csv_box.get():
             self.export_csv()
         if self.pix_box.get():
             self.export_pix()
-        if self.chip_png_var.get() or self.chip_sicd_var.get():
+        if self.chip_png_var.get() or self.chip_sicd_var.get() or self.chip_npy_var.get():
             self.chip()
-        self.indexes = []
+
         self.clear_rect()
         if self.current_image_index is not None:
+            self.direction = increment
             self.current_image_index = (self.current_image_index + increment)% len(self.image_paths)
             self.show_current_image()
             if self.bb_button.get():
@@ -384,25 +489,17 @@ class VisionLabelApp:
         self.image_change(increment=-1)
     
     def import_bounding_boxes(self):
-        text_file_name = self.image_paths[self.current_image_index].replace(".png",".txt").replace(".ntf", ".txt").replace(".nitf", ".txt")
-        if text_file_name in [(self.directory + '/' + i) for i in os.listdir(self.directory)]:
-            with open(text_file_name, "r") as f:
-                lines = f.readlines()
-            for templine in lines:
-                line = templine.split(" ")
-                print(line)
-                if len(line)!=5:
-                    print("bounding box file error")
-                    return 
-                self.indexes.append(line[0])
-                coords = [(self.width*(float(line[1])-float(line[3])/2),
-                        self.height*(float(line[2])-float(line[4])/2)),
-                        (self.width*(float(line[1])+float(line[3])/2),
-                        self.height*(float(line[2])+float(line[4])/2))]
-                # self.image.rectangle(shape, outline ="red")
-                self.rect = self.canvas.create_rectangle(coords[0][0], coords[0][1], coords[1][0], coords[1][1], fill="", outline="red")
-
-                self.shapes.append(self.rect)
+        image_path = self.image_paths[self.current_image_index]
+        # an Export Rectangles TXT of this image may still be queued, read the file only once it is written
+        self.writer.wait(yolo_path(image_path))
+        text_file_name = self.label_file(image_path)
+        if text_file_name:
+            labels, coords, bad_rows = read_yolo(text_file_name, self.width, self.height)
+            if bad_rows:
+                print(f"bounding box file error, skipped lines {bad_rows} of {text_file_name}")
+            # one batch into the model, only the boxes in view become canvas items
+            self.annotations.extend(coords, 0, labels)
+            self.draw_annotations()
         else:
             print("No Bounding Box File Found")
 
@@ -414,14 +511,16 @@ class VisionLabelApp:
             print("End of the line partner")
         elif len(self.image_paths)==1:
             deletion_file = self.image_paths[self.current_image_index]
+            self.writer.flush()  # nothing may still be writing the files about to be deleted
+            deletion_txt = self.label_file(deletion_file)
             os.remove(deletion_file)
-            deletion_txt = deletion_file[0:deletion_file.rfind('.')] + '.txt'
-            if os.path.isfile(deletion_txt):
+            self.image_cache.discard(deletion_file)
+            if deletion_txt:
                 os.remove(deletion_txt)
             deletion_file_pair = deletion_file.replace('static', 'moving')
             if os.path.isfile(deletion_file_pair):
                 os.remove(deletion_file_pair)
-            self.image_paths.pop(self.current_image_index)
+            self.forget_image(deletion_file)
         else:
             if self.csv_box.get():
                 self.export_csv()
@@ -429,6 +528,7 @@ class VisionLabelApp:
                 self.export_pix()
             
 
+            deletion_file = self.image_paths[self.current_image_index]
             self.clear_rect()
             if self.current_image_index is not None:
                 self.current_image_index = (self.current_image_index + 1)% len(self.image_paths)
@@ -438,15 +538,36 @@ class VisionLabelApp:
                 if self.bb_button.get():
 
                     self.import_bounding_boxes()
-            self.current_image_index-=1
-            deletion_file = self.image_paths[self.current_image_index]
+            shown_file = self.image_paths[self.current_image_index]
+            self.writer.flush()
+            deletion_txt = self.label_file(deletion_file)
             os.remove(deletion_file)
-            deletion_txt = deletion_file[0:deletion_file.rfind('.')] + '.txt'
-            if os.path.isfile(deletion_txt):
+            self.image_cache.discard(deletion_file)
+            if deletion_txt:
                 os.remove(deletion_txt)
-            self.image_paths.pop(self.current_image_index)
+            self.forget_image(deletion_file)
+            self.current_image_index = self.image_position(shown_file)
         # self.image_paths[self.current_image_index]
 
+    def label_file(self, path):
+        ''' The YOLO file next to path, or None when there is none '''
+        if self.dir_index is not None:
+            return self.dir_index.label_path(path)
+        label = yolo_path(path)
+        return label if os.path.isfile(label) else None
+
+    def image_position(self, path):
+        if self.dir_index is not None:
+            return self.dir_index.position(path)
+        return self.image_paths.index(path)
+
+    def forget_image(self, path):
+        ''' Drop a deleted image from the navigation list '''
+        if self.dir_index is not None:
+            self.dir_index.remove(path)  # image_paths is the index's own list
+        else:
+            self.image_paths.remove(path)
+
     def on_button_press(self, event):
         # create rectangle if not yet exist
         self.root.focus_force()
@@ -456,33 +577,47 @@ class VisionLabelApp:
         self.start_y = y
         radio = self.radio.get()
         if radio <2:
+            label = self.class_label() if radio == 0 else 0
+            if label is None:
+                # no canvas item without an annotation behind it
+                print(f"Class Label must be a non-negative whole number, not {self.txt.get()!r}")
+                return
             if radio == 0:
-                self.rect = self.canvas.create_rectangle(x, y, x, y, fill="", outline="red")
-                self.shapes.append(self.rect)
-                # print(self.txt.get())
-                # print('a')
-                self.indexes.append(self.txt.get())
-                # print(self.indexes)
+                self.rect = self.canvas.create_rectangle(x, y, x, y, fill="", outline="red", tags="shape")
+                item = self.rect
             elif radio ==1:
-                self.line = self.canvas.create_line(x,y,x,y, fill='red', width=3)
-                self.shapes.append(self.line)
-            self.shape_type.append(radio)
+                self.line = self.canvas.create_line(x,y,x,y, fill='red', width=3, tags="shape")
+                item = self.line
+            self.start_image = self.to_image(x, y)
+            self.shape_index = self.annotations.add(self.start_image * 2, radio, label, item)
         elif radio ==2 :
             ''' Remember previous coordinates for scrolling with the mouse '''
             self.canvas.scan_mark(event.x, event.y)
 
+    def class_label(self):
+        ''' The Class Label entry as an int, or None when it is not a non-negative whole number '''
+        try:
+            label = int(self.txt.get())
+        except ValueError:
+            return None
+        return label if label >= 0 else None
+
     def on_move_press(self, event):
         # expand rectangle as you drag the mouse
         x = self.canvas.canvasx(event.x)
         y = self.canvas.canvasy(event.y)
+        if self.radio.get() < 2 and self.shape_index is None:
+            return  # the press did not start a shape
         if self.radio.get() == 0:
             self.canvas.coords(self.rect, self.start_x, self.start_y, x, y)
+            self.annotations.update(self.shape_index, self.start_image + self.to_image(x, y))
         elif self.radio.get() ==1:
             self.canvas.coords(self.line, self.start_x, self.start_y, x, y)
+            self.annotations.update(self.shape_index, self.start_image + self.to_image(x, y))
         elif self.radio.get() ==2:
             ''' Drag (move) canvas to the new position '''
             self.canvas.scan_dragto(event.x, event.y, gain=1)
-            self.update_image()  # redraw the image
+            self.request_render()  # redraw the image on the next frame
 
     def move_from(self, event):
         ''' Remember previous coordinates for scrolling with the mouse '''
@@ -498,47 +633,19 @@ class VisionLabelApp:
         self.rect_zoom = self.imscale
         self.rect = None
         self.line = None
+        self.shape_index = None
 
     def right_click(self,event):
-        if self.shapes:
-            x = self.canvas.canvasx(event.x)
-            y = self.canvas.canvasy(event.y)
-            final_index = 0
-            dist = 1e7 
-            is_line = False
-            for i, shape in enumerate(self.shapes):
-                x1, y1, x2, y2 = self.get_shape_coords(shape)
-                if self.shape_type[i] == 0:
-                    xdist = min(abs(x1-x),abs(x2-x))
-                    ydist = min(abs(y1-y),abs(y2-y))
-                    if x < x2 and x > x1 and y < y2 and y > y1:
-                        ydist = min(ydist, xdist)
-                        xdist = 0 
-                    else:
-                        if x < max(x1,x2) and x > min(x2,x1):
-                            xdist= 0  
-                        if y < max(y1,y2) and y > min(y2,y1):
-                            ydist= 0  
-                    curr_dist = (xdist**2 + ydist**2)**0.5
-                    if curr_dist < dist:
-                        is_line = False
-                        dist = curr_dist
-                        final_index = self.shapes[i]
-                else:
-                    slope = (y2-y1)/(x2-x1)
-                    added = y1 - slope * x1
-                    x_closest = (x+ slope * (y - added))/(1+slope**2)
-                    x_closest = max(x_closest, min(x1,x2))
-                    x_closest = min(x_closest, max(x1,x2))
-                    curr_dist = ((x_closest-x)**2 + ((x_closest * slope + added - y))**2)**0.5
-                    if curr_dist < dist:
-                        is_line = True
-                        dist = curr_dist
-                        final_index = self.shapes[i]
-            if not is_line:
-                self.indexes.pop(self.shapes.index(final_index))
-            self.canvas.delete(self.shapes.pop(self.shapes.index(final_index)))
-
+        if len(self.annotations):
+            x, y = self.to_image(self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+            # grid index lookup, only shapes in the cells around the click are measured
+            self.delete_shape(self.annotations.nearest(x, y))
+
+    def delete_shape(self, index):
+        item = self.annotations.remove(index)
+        if item >= 0:
+            self.canvas.delete(item)
+        self.draw_annotations()
     
     def middle_click(self, event):
         if self.radio.get()==0:
@@ -549,47 +656,73 @@ class VisionLabelApp:
             self.radio.set(0)
 
     def clear_rect(self):
-        while self.shapes:
-            self.canvas.delete(self.shapes.pop())
+        self.canvas.delete("shape", "overlay")
+        self.annotations.clear()
 
+    @probe.timed('export_pix')
     def export_pix(self):
         w, h = self.image.width, self.image.height
-        vals = []
-        for i, shape in enumerate(self.shapes):
-            x1, y1, x2, y2 = self.get_shape_coords(shape)
-            vals.append([(x1 +x2)/(2*w),(y1 +y2)/(2*h), abs(x1-x2)/(w),abs(y1 -y2)/(h)])
-        output_file = self.image_paths[self.current_image_index].replace(".png",".txt").replace(".ntf",".txt").replace(".nitf",".txt")
-
-        with open(output_file, "w") as f:
-            print(vals)
-            print('vals')
-            for i in range(len(vals)):
-                # print(i)
-                # print
-                f.write(f"{str(self.indexes[i])} {str(vals[i][0])} {str(vals[i][1])} {str(vals[i][2])} {str(vals[i][3])}\n")
+        labels, vals = self.annotations.yolo(w, h)
+        output_file = yolo_path(self.image_paths[self.current_image_index])
+        self.writer.submit(output_file, probe.wrap('export_pix write', write_yolo_file), output_file, labels, vals)
+        if self.dir_index is not None:
+            self.dir_index.set_label(self.image_paths[self.current_image_index], output_file)
+
 
+    def annotation_store(self, directory):
+        if directory not in self.annotation_stores:
+            self.annotation_stores[directory] = AnnotationStore.for_directory(directory)
+        return self.annotation_stores[directory]
+
+    @probe.timed('export_csv')
     def export_csv(self):
-        columns = ['center', "corner0","corner1", "corner2", "corner3"]
-        column_names = ["name"]
-        column_names.extend([f"{column}_{xy}" for column in columns for xy in ['x', 'y']])
-        # column_names.extend([f"{column}_{latlon}" for column in columns for latlon in ['lat', 'lon']])
-        csv = os.path.join(self.directory,"bounding_box.csv")
-        if os.path.isfile(csv):
-            df = pd.read_csv(csv)
+        ''' Save the current image's shapes to its directory's annotation store '''
+        file_path = self.image_paths[self.current_image_index]
+        count = len(self.annotations)
+        shapes = [(shape_type, label if shape_type == 0 else None, *coords)
+                  for shape_type, label, coords in zip(self.annotations.types[:count], self.annotations.labels[:count],
+                                                       self.annotations.clipped(self.width, self.height))]
+        # replaces just this image's rows, bounding_box.csv is written from the store on demand
+        directory = os.path.dirname(file_path)
+        self.writer.submit(directory, probe.wrap('export_csv write', self.annotation_store(directory).save_image),
+                           os.path.basename(file_path), shapes, size=(self.width, self.height))
+
+    def toggle_timings(self):
+        probe.enabled = self.show_timings.get()
+        # at most one refresh loop, however quickly the menu is toggled
+        if self.timings_job is not None:
+            self.root.after_cancel(self.timings_job)
+            self.timings_job = None
+        if probe.enabled:
+            self.draw_timings()
         else:
-            df = pd.DataFrame(columns=column_names)
-        for i, shape in enumerate(self.shapes):
-            x1, y1,x2,y2 = self.get_shape_coords(shape)
-            if self.shape_type[i] == 0:
-                xy_arr = np.concatenate([[os.path.basename(self.image_paths[self.current_image_index])],
-                                           [(x1+x2)/2, (y1+y2)/2, x1,y1, x2,y1, x2,y2, x1,y2]])
-            else:
-                xy_arr = np.concatenate([[os.path.basename(self.image_paths[self.current_image_index])],
-                                           [(x1+x2)/2, (y1+y2)/2, x1,y1, x2,y2],
-                                           [np.nan,np.nan, np.nan, np.nan]])
-            df.loc[len(df)] = xy_arr
-        df.drop_duplicates(keep='first', inplace=True)
-        df.to_csv(csv, index=False)
+            self.canvas.delete("timings")
+
+    def draw_timings(self):
+        ''' Rolling percentiles drawn over the top left of the canvas, refreshed twice a second '''
+        self.timings_job = None
+        if not probe.enabled:
+            return
+        self.canvas.delete("timings")
+        text = self.canvas.create_text(self.canvas.canvasx(8), self.canvas.canvasy(8), anchor='nw', text=probe.summary(),
+                                       fill="yellow", font=("Courier", 10), tags="timings")
+        background = self.canvas.create_rectangle(self.canvas.bbox(text), fill="black", outline="", tags="timings")
+        self.canvas.tag_lower(background, text)
+        self.timings_job = self.root.after(500, self.draw_timings)
+
+    def dump_trace(self):
+        path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("Chrome trace", "*.json")])
+        if path:
+            probe.dump(path)
+
+    def write_csv(self):
+        # queued behind the saves of the same directory
+        for directory, store in self.annotation_stores.items():
+            self.writer.submit(directory, store.export_csv, os.path.join(directory, "bounding_box.csv"))
+
+    def write_yolo(self):
+        for directory, store in self.annotation_stores.items():
+            self.writer.submit(directory, store.export_yolo, directory)
 
 def main():
     root = tk.Tk()
@@ -600,6 +733,11 @@ def main():
     # Set focus to the canvas after a short delay
     root.after(100, root.focus_force)
     root.mainloop()
+    app.prefetcher.close()
+    app.write_csv()
+    app.writer.close()  # waits for every queued export
+    if app.remap_cache is not None:
+        app.remap_cache.close(wait=False)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,97 @@
+import os
+import csv
+import sqlite3
+
+COLUMNS = ['center', "corner0", "corner1", "corner2", "corner3"]
+COLUMN_NAMES = ["name"] + [f"{column}_{xy}" for column in COLUMNS for xy in ['x', 'y']]
+
+BOX, LINE = 0, 1
+
+
+def csv_row(name, shape_type, x1, y1, x2, y2):
+    ''' A bounding_box.csv row: centre and four corners for boxes, centre and end points for lines '''
+    if shape_type == BOX:
+        return [name, (x1+x2)/2, (y1+y2)/2, x1, y1, x2, y1, x2, y2, x1, y2]
+    return [name, (x1+x2)/2, (y1+y2)/2, x1, y1, x2, y2, '', '', '', '']
+
+
+class AnnotationStore:
+    ''' SQLite store of every image's shapes, the source of bounding_box.csv and YOLO exports
+
+    Shapes are keyed by (image name, shape number) and saved one image at a
+    time, so a save costs the same however many images are already labelled.
+    '''
+
+    def __init__(self, path, legacy_csv=None):
+        is_new = not os.path.isfile(path)
+        # saves run on the export writer's thread, other calls on the Tk thread after a flush
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS shapes (
+                image TEXT NOT NULL, shape INTEGER NOT NULL, type INTEGER NOT NULL, label TEXT,
+                x1 REAL NOT NULL, y1 REAL NOT NULL, x2 REAL NOT NULL, y2 REAL NOT NULL,
+                PRIMARY KEY (image, shape));
+            CREATE TABLE IF NOT EXISTS images (
+                image TEXT PRIMARY KEY, width INTEGER, height INTEGER);
+        ''')
+        if is_new and legacy_csv and os.path.isfile(legacy_csv):
+            self.import_csv(legacy_csv)
+
+    @classmethod
+    def for_directory(cls, directory):
+        ''' The store kept next to a directory's bounding_box.csv, seeded from that CSV the first time '''
+        return cls(os.path.join(directory, "annotations.sqlite"), legacy_csv=os.path.join(directory, "bounding_box.csv"))
+
+    def save_image(self, image, shapes, size=None):
+        ''' Replace every shape of image with shapes, a list of (type, label, x1, y1, x2, y2) '''
+        with self.conn:
+            self.conn.execute("DELETE FROM shapes WHERE image = ?", (image,))
+            self.conn.executemany("INSERT INTO shapes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                  [(image, k, int(t), None if label is None else str(label), float(x1), float(y1), float(x2), float(y2))
+                                   for k, (t, label, x1, y1, x2, y2) in enumerate(shapes)])
+            if size is not None:
+                self.conn.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?)", (image, int(size[0]), int(size[1])))
+
+    def shapes(self, image):
+        return self.conn.execute("SELECT type, label, x1, y1, x2, y2 FROM shapes WHERE image = ? ORDER BY shape",
+                                 (image,)).fetchall()
+
+    def import_csv(self, csv_path):
+        ''' Load an existing bounding_box.csv, keeping the first copy of any duplicated row '''
+        per_image = {}
+        with open(csv_path, newline='') as f:
+            for row in csv.DictReader(f):
+                shape = (BOX if row["corner2_x"] not in ('', 'nan') else LINE, None,
+                         float(row["corner0_x"]), float(row["corner0_y"]), float(row["corner1_x"]), float(row["corner1_y"]))
+                if shape[0] == BOX:
+                    # corner1 of a box is (x2, y1), corner2 carries y2
+                    shape = shape[:5] + (float(row["corner2_y"]),)
+                shapes = per_image.setdefault(row["name"], [])
+                if shape not in shapes:
+                    shapes.append(shape)
+        for image, shapes in per_image.items():
+            self.save_image(image, shapes)
+
+    def export_csv(self, csv_path):
+        ''' Write bounding_box.csv for every image in the store '''
+        with open(csv_path, "w", newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMN_NAMES)
+            for row in self.conn.execute("SELECT image, type, x1, y1, x2, y2 FROM shapes ORDER BY image, shape"):
+                writer.writerow(csv_row(*row))
+
+    def export_yolo(self, directory):
+        ''' Write a YOLO .txt next to every image with a known size, returning how many were written '''
+        written = 0
+        for image, width, height in self.conn.execute("SELECT image, width, height FROM images").fetchall():
+            rows = self.conn.execute("SELECT label, x1, y1, x2, y2 FROM shapes WHERE image = ? AND type = ? ORDER BY shape",
+                                     (image, BOX)).fetchall()
+            with open(os.path.join(directory, os.path.splitext(image)[0] + ".txt"), "w") as f:
+                for label, x1, y1, x2, y2 in rows:
+                    f.write(f"{label if label is not None else 0} {(x1+x2)/(2*width)} {(y1+y2)/(2*height)} "
+                            f"{abs(x1-x2)/width} {abs(y1-y2)/height}\n")
+            written += 1
+        return written
+
+    def close(self):
+        self.conn.close()
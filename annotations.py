@@ -0,0 +1,318 @@
+import os
+import math
+import numpy as np
+
+BOX, LINE = 0, 1
+
+
+def yolo_path(image_path):
+    ''' The YOLO label file kept next to an image '''
+    return os.path.splitext(image_path)[0] + ".txt"
+
+
+def yolo_lines(labels, rows):
+    ''' YOLO label file text of rows, (n, 4) centre x, centre y, width, height '''
+    return "".join(f"{label} {i[0]} {i[1]} {i[2]} {i[3]}\n" for label, i in zip(labels, rows))
+
+
+def write_yolo_file(path, labels, rows):
+    ''' Write YOLO label rows, (n, 4) centre x, centre y, width, height, to path '''
+    with open(path, "w") as f:
+        f.write(yolo_lines(labels, rows))
+
+
+def chip_yolo(labels, coords, box, min_visible=0.5):
+    ''' (labels, YOLO rows) of the pixel coords boxes inside chip box, clipped to it and normalised to its size
+
+    A box is kept when at least min_visible of its area falls inside the chip.
+    '''
+    left, upper, right, lower = box
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+    clipped = np.clip(coords, [left, upper, left, upper], [right, lower, right, lower])
+    area = np.prod(coords[:, 2:] - coords[:, :2], axis=1)
+    inside = np.prod(np.maximum(clipped[:, 2:] - clipped[:, :2], 0), axis=1)
+    keep = (inside > 0) & (inside >= min_visible * area)
+    x1, y1, x2, y2 = (clipped[keep] - [left, upper, left, upper]).T
+    width, height = right - left, lower - upper
+    return np.asarray(labels)[keep], np.stack([(x1 + x2) / (2 * width), (y1 + y2) / (2 * height),
+                                               (x2 - x1) / width, (y2 - y1) / height], axis=1)
+
+
+def _parse_rows(lines):
+    ''' (n, 5) float rows of lines, NaN rows where a line is not five numbers '''
+    rows = np.full((len(lines), 5), np.nan)
+    for k, line in enumerate(lines):
+        fields = line.split()
+        if len(fields) == 5:
+            try:
+                rows[k] = [float(field) for field in fields]
+            except ValueError:
+                pass
+    return rows
+
+
+def read_yolo(path, width, height):
+    ''' Boxes of a YOLO label file as (labels, (n, 4) pixel x1, y1, x2, y2, bad line numbers)
+
+    Well formed files are parsed in one loadtxt call; otherwise lines are
+    parsed one at a time so a bad line only drops itself. Rows are then
+    validated together: the label must be a non-negative integer and every
+    value finite, with non-negative sizes.
+    '''
+    with open(path) as f:
+        lines = f.read().splitlines()
+    numbers = np.arange(1, len(lines) + 1)
+    keep = np.array([bool(line.strip()) for line in lines], dtype=bool)
+    lines, numbers = [line for line, k in zip(lines, keep) if k], numbers[keep]
+    try:
+        rows = np.loadtxt(lines, ndmin=2, dtype=np.float64) if lines else np.zeros((0, 5))
+        if rows.shape[1] != 5:
+            raise ValueError
+    except ValueError:
+        rows = _parse_rows(lines)
+    label, cx, cy, w, h = rows.T
+    good = (np.isfinite(rows).all(axis=1) & (label >= 0) & (label == np.floor(label)) & (w >= 0) & (h >= 0))
+    label, cx, cy, w, h = rows[good].T
+    coords = np.stack([width * (cx - w / 2), height * (cy - h / 2),
+                       width * (cx + w / 2), height * (cy + h / 2)], axis=1)
+    return label.astype(np.int32), coords, numbers[~good].tolist()
+
+
+class GridIndex:
+    ''' Uniform grid of buckets over image space, mapping cells to the keys of shapes whose bounds touch them
+
+    Shapes covering more than max_cells cells are kept in a separate list that
+    every query checks, so one image-sized box does not fill the whole grid.
+    '''
+
+    def __init__(self, cell_size=128, max_cells=256):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.buckets = {}
+        self.spanning = set()
+        self.cells = {}  # key -> cells it was inserted into, None when spanning
+        self.bounds = None  # (min cx, min cy, max cx, max cy) of every cell ever used
+
+    def _cell_range(self, bounds):
+        x1, y1, x2, y2 = bounds
+        size = self.cell_size
+        return (math.floor(min(x1, x2) / size), math.floor(min(y1, y2) / size),
+                math.floor(max(x1, x2) / size), math.floor(max(y1, y2) / size))
+
+    def insert(self, key, bounds):
+        cx1, cy1, cx2, cy2 = self._cell_range(bounds)
+        if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > self.max_cells:
+            self.spanning.add(key)
+            self.cells[key] = None
+            return
+        cells = [(cx, cy) for cx in range(cx1, cx2 + 1) for cy in range(cy1, cy2 + 1)]
+        for cell in cells:
+            self.buckets.setdefault(cell, set()).add(key)
+        self.cells[key] = cells
+        if self.bounds is None:
+            self.bounds = (cx1, cy1, cx2, cy2)
+        else:
+            b = self.bounds
+            self.bounds = (min(b[0], cx1), min(b[1], cy1), max(b[2], cx2), max(b[3], cy2))
+
+    def remove(self, key):
+        cells = self.cells.pop(key, None)
+        if cells is None:
+            self.spanning.discard(key)
+            return
+        for cell in cells:
+            bucket = self.buckets[cell]
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[cell]
+
+    def clear(self):
+        self.buckets.clear()
+        self.spanning.clear()
+        self.cells.clear()
+        self.bounds = None
+
+    def ring(self, x, y, r):
+        ''' Keys in the cells at Chebyshev distance r from the cell holding (x, y) '''
+        cx, cy = math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+        keys = set()
+        if r == 0:
+            cells = [(cx, cy)]
+        else:
+            cells = [(cx + dx, cy + dy) for dx in range(-r, r + 1) for dy in (-r, r)]
+            cells += [(cx + dx, cy + dy) for dx in (-r, r) for dy in range(-r + 1, r)]
+        for cell in cells:
+            keys |= self.buckets.get(cell, set())
+        return keys
+
+    def rings_needed(self, x, y):
+        ''' Rings after which every bucketed cell has been visited '''
+        if self.bounds is None:
+            return 0
+        cx, cy = math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+        b = self.bounds
+        return max(cx - b[0], b[2] - cx, cy - b[1], b[3] - cy, 0)
+
+
+class Annotations:
+    ''' Struct-of-arrays container of the current image's shapes in image pixel coordinates
+
+    This is the source of truth for boxes and lines; canvas items are only a
+    view of it, linked through items. Boxes are stored with x1 <= x2 and
+    y1 <= y2, lines keep their drawn start and end points. Every shape also
+    gets a key that never changes, kept increasing in drawing order, which
+    the spatial index uses to find shapes without scanning them all.
+    '''
+
+    def __init__(self, capacity=64, cell_size=128):
+        self.coords = np.zeros((capacity, 4), dtype=np.float64)  # x1, y1, x2, y2
+        self.types = np.zeros(capacity, dtype=np.int8)
+        self.labels = np.zeros(capacity, dtype=np.int32)
+        self.items = np.full(capacity, -1, dtype=np.int64)  # canvas item id, -1 when not drawn
+        self.keys = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+        self.next_key = 0
+        self.index = GridIndex(cell_size)
+
+    def __len__(self):
+        return self.count
+
+    def _reserve(self, extra):
+        needed = self.count + extra
+        if needed <= len(self.types):
+            return
+        capacity = max(needed, 2 * len(self.types))
+        for name in ('coords', 'types', 'labels', 'items', 'keys'):
+            old = getattr(self, name)
+            grown = np.full((capacity,) + old.shape[1:], -1 if name == 'items' else 0, dtype=old.dtype)
+            grown[:self.count] = old[:self.count]
+            setattr(self, name, grown)
+
+    @staticmethod
+    def _normalise(coords, types):
+        # boxes are kept corner-ordered, the same way Tk stores rectangle coordinates
+        boxes = types == BOX
+        x1, y1, x2, y2 = coords[boxes].T.copy()
+        coords[boxes] = np.stack([np.minimum(x1, x2), np.minimum(y1, y2), np.maximum(x1, x2), np.maximum(y1, y2)], axis=1)
+        return coords
+
+    def add(self, coords, shape_type, label=0, item=-1):
+        ''' Append one shape, returning its index '''
+        return self.extend([coords], [shape_type], [label], [item]).start
+
+    def extend(self, coords, types, labels, items=None):
+        ''' Append shapes in bulk, returning the slice they occupy '''
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+        types = np.broadcast_to(np.asarray(types, dtype=np.int8), len(coords))
+        n = len(coords)
+        self._reserve(n)
+        start = self.count
+        self.coords[start:start + n] = self._normalise(coords.copy(), types)
+        self.types[start:start + n] = types
+        self.labels[start:start + n] = np.broadcast_to(np.asarray(labels, dtype=np.int32), n)
+        self.items[start:start + n] = -1 if items is None else np.asarray(items, dtype=np.int64)
+        self.keys[start:start + n] = np.arange(self.next_key, self.next_key + n)
+        self.next_key += n
+        self.count += n
+        for key, bounds in zip(self.keys[start:start + n].tolist(), self.coords[start:start + n].tolist()):
+            self.index.insert(key, bounds)
+        return slice(start, start + n)
+
+    def update(self, index, coords):
+        self.coords[index] = self._normalise(np.asarray(coords, dtype=np.float64).reshape(1, 4), self.types[index:index + 1])[0]
+        key = int(self.keys[index])
+        self.index.remove(key)
+        self.index.insert(key, self.coords[index].tolist())
+
+    def remove(self, index):
+        ''' Drop one shape keeping the others in drawing order, returning its canvas item '''
+        item = int(self.items[index])
+        self.index.remove(int(self.keys[index]))
+        for array in (self.coords, self.types, self.labels, self.items, self.keys):
+            array[index:self.count - 1] = array[index + 1:self.count]
+        self.count -= 1
+        self.items[self.count] = -1
+        return item
+
+    def clear(self):
+        self.count = 0
+        self.items[:] = -1
+        self.index.clear()
+
+    def clipped(self, width, height):
+        ''' Coordinates clipped to the image, as exports and chips use them '''
+        coords = self.coords[:self.count].copy()
+        np.maximum(coords[:, :2], 0, out=coords[:, :2])
+        np.minimum(coords[:, 2], width, out=coords[:, 2])
+        np.minimum(coords[:, 3], height, out=coords[:, 3])
+        return coords
+
+    def box_rows(self, width, height):
+        ''' (labels, clipped box coordinates) of every box '''
+        boxes = self.types[:self.count] == BOX
+        return self.labels[:self.count][boxes], self.clipped(width, height)[boxes]
+
+    def yolo(self, width, height):
+        ''' (labels, centre x, centre y, width, height) of every box, normalised to the image size '''
+        labels, coords = self.box_rows(width, height)
+        x1, y1, x2, y2 = coords.T
+        return labels, np.stack([(x1 + x2) / (2 * width), (y1 + y2) / (2 * height),
+                                 np.abs(x1 - x2) / width, np.abs(y1 - y2) / height], axis=1)
+
+    def in_view(self, bounds):
+        ''' Mask of the shapes whose bounds overlap the image-space (x1, y1, x2, y2) view '''
+        x1, y1, x2, y2 = self.coords[:self.count].T
+        return ((np.minimum(x1, x2) <= bounds[2]) & (np.maximum(x1, x2) >= bounds[0]) &
+                (np.minimum(y1, y2) <= bounds[3]) & (np.maximum(y1, y2) >= bounds[1]))
+
+    def density(self, bounds, shape, mask=None):
+        ''' Count of shape centres in each cell of a (rows, cols) grid laid over the view bounds '''
+        coords = self.coords[:self.count] if mask is None else self.coords[:self.count][mask]
+        counts, _, _ = np.histogram2d((coords[:, 1] + coords[:, 3]) / 2, (coords[:, 0] + coords[:, 2]) / 2,
+                                      bins=shape, range=[[bounds[1], bounds[3]], [bounds[0], bounds[2]]])
+        return counts
+
+    def distances(self, x, y, indexes=None):
+        ''' Distance from (x, y) to every shape, or to shapes indexes: box edges for boxes, the segment for lines '''
+        if indexes is None:
+            indexes = slice(0, self.count)
+        x1, y1, x2, y2 = self.coords[indexes].T
+        # boxes: distance to the box from outside, to the nearest edge from inside
+        xdist = np.minimum(np.abs(x1 - x), np.abs(x2 - x))
+        ydist = np.minimum(np.abs(y1 - y), np.abs(y2 - y))
+        in_x = (np.minimum(x1, x2) < x) & (x < np.maximum(x1, x2))
+        in_y = (np.minimum(y1, y2) < y) & (y < np.maximum(y1, y2))
+        box = np.where(in_x & in_y, np.minimum(xdist, ydist),
+                       np.hypot(np.where(in_x, 0, xdist), np.where(in_y, 0, ydist)))
+        # lines: distance to the closest point of the segment
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+        t = np.clip(((x - x1) * dx + (y - y1) * dy) / np.where(length > 0, length, 1), 0, 1)
+        line = np.hypot(x1 + t * dx - x, y1 + t * dy - y)
+        return np.where(self.types[indexes] == BOX, box, line)
+
+    def nearest(self, x, y):
+        ''' Index of the shape closest to (x, y), or None when there are none
+
+        Grid rings around (x, y) are visited outwards until the best distance
+        found is shorter than the distance to the next ring, since a shape is
+        never closer than its bounds. Ties go to the earliest drawn shape, the
+        same answer as an argmin over every shape.
+        '''
+        if self.count == 0:
+            return None
+        grid = self.index
+        keys = set(grid.spanning)
+        best, best_index = math.inf, None
+        last = grid.rings_needed(x, y)
+        for r in range(last + 1):
+            keys |= grid.ring(x, y, r)
+            if keys:
+                # keys run in drawing order, so a sorted lookup turns them into indexes
+                indexes = np.searchsorted(self.keys[:self.count], sorted(keys))
+                distances = self.distances(x, y, indexes)
+                k = int(np.argmin(distances))
+                best, best_index = distances[k], int(indexes[k])
+            if best < r * grid.cell_size:
+                break
+        return best_index
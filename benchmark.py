@@ -0,0 +1,271 @@
+''' Reproducible timings of the non-GUI work behind the app's main actions
+
+Generates a synthetic SICD NITF (through sarpy's SICDWriter) and PNG/JPEG
+pictures of a chosen size, then times the code that open, render, pan, zoom,
+Export Shapes CSV, Export Rectangles TXT, Export Chips (PNG/SICD and NPY) and
+Export Chip Grid run, without Tk. Every stage reports its wall times and the
+peak Python/numpy allocation of one extra traced run (PIL's own buffers are not
+traced, the process max RSS is reported alongside), as JSON, so runs on
+different commits can be diffed. Sizes at or under 2048 pixels exercise the
+small picture path.
+
+    python benchmark.py --rows 8192 --cols 8192 --shapes 2000 --output before.json
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+import numpy as np
+from PIL import Image
+from sarpy.io.complex.sicd import SICDWriter
+from sarpy.io.complex.sicd_elements.SICD import SICDType
+from sarpy.io.complex.sicd_elements.ImageData import ImageDataType, FullImageType
+from sarpy.io.complex.sicd_elements.CollectionInfo import CollectionInfoType
+from sarpy.io.complex.sicd_elements.Timeline import TimelineType
+from sarpy.io.complex.sicd_elements.blocks import RowColType
+from sarpy.visualization.remap import Density
+from image_sources import load_image
+from annotations import Annotations, read_yolo, write_yolo_file, yolo_path
+from annotation_store import AnnotationStore
+from chip_export import grid_plan, export_grid, write_box_chips
+
+DELTA = 1.3  # wheel zoom step, the same as the app's
+
+
+def speckle(rng, rows, cols):
+    ''' Complex Rayleigh-amplitude clutter, the statistics the Density remap is built for '''
+    amplitude = rng.rayleigh(1.0, (rows, cols)).astype(np.float32)
+    phase = rng.uniform(0, 2 * np.pi, (rows, cols)).astype(np.float32)
+    return amplitude * np.exp(1j * phase).astype(np.complex64)
+
+
+def make_sicd(path, rows, cols, seed=0, block_rows=1024):
+    ''' Write a synthetic rows x cols SICD, one row block at a time '''
+    meta = SICDType(
+        CollectionInfo=CollectionInfoType(CollectorName='SYNTHETIC', CoreName='SYNTHETIC', CollectType='MONOSTATIC',
+                                          Classification='UNCLASSIFIED'),
+        Timeline=TimelineType(CollectStart=np.datetime64('2020-01-01T00:00:00'), CollectDuration=1.0),
+        ImageData=ImageDataType(PixelType='RE32F_IM32F', NumRows=rows, NumCols=cols, FirstRow=0, FirstCol=0,
+                                FullImage=FullImageType(NumRows=rows, NumCols=cols),
+                                SCPPixel=RowColType(Row=rows // 2, Col=cols // 2)))
+    rng = np.random.default_rng(seed)
+    with SICDWriter(path, meta, check_existence=False) as writer:
+        for upper in range(0, rows, block_rows):
+            writer.write_chip(speckle(rng, min(block_rows, rows - upper), cols), start_indices=(upper, 0))
+
+
+def make_picture(path, width, height, seed=0, block_rows=1024):
+    ''' Write a synthetic 8-bit greyscale PNG or JPEG with speckle-like texture '''
+    rng = np.random.default_rng(seed)
+    pixels = np.empty((height, width), dtype=np.uint8)
+    for upper in range(0, height, block_rows):
+        block = rng.rayleigh(48.0, (min(block_rows, height - upper), width))
+        pixels[upper:upper + len(block)] = np.clip(block, 0, 255)
+    Image.fromarray(pixels).save(path)
+
+
+def random_boxes(rng, width, height, count, size=(16, 256)):
+    ''' (count, 4) integer boxes inside the image '''
+    wh = rng.integers(size[0], size[1], (count, 2))
+    xy = rng.integers(0, [max(1, width - size[1]), max(1, height - size[1])], (count, 2))
+    return np.hstack([xy, xy + wh]).astype(np.float64)
+
+
+def measure(name, fn, repeat, setup=None):
+    ''' Time fn repeat times, then run it once more under tracemalloc for its peak allocation '''
+    seconds = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'stage': name, 'seconds': seconds, 'median': statistics.median(seconds), 'min': min(seconds),
+            'peak_bytes': peak}
+
+
+def view_box(width, height, scale, centre, canvas):
+    ''' The full resolution box and screen size update_image crops for a view centred on centre '''
+    cw, ch = canvas
+    vw, vh = cw / scale, ch / scale
+    x1, y1 = max(0, centre[0] - vw / 2), max(0, centre[1] - vh / 2)
+    x2, y2 = min(width, x1 + vw), min(height, y1 + vh)
+    return (int(x1), int(y1), int(x2), int(y2)), (max(1, int((x2 - x1) * scale)), max(1, int((y2 - y1) * scale)))
+
+
+def render(pyramid, width, height, scale, centre, canvas):
+    box, size = view_box(width, height, scale, centre, canvas)
+    # tobytes stands in for the copy PhotoImage makes of the tile
+    pyramid.crop(box, scale, size).tobytes()
+
+
+def bench_file(file_path, args, workdir):
+    ''' Every stage for one input file '''
+    remap = Density()
+    rng = np.random.default_rng(args.seed)
+    results = []
+    opened = {}
+
+    def open_image():
+        opened['image'], opened['sicd'], opened['pyramid'] = load_image(file_path, remap)
+        if opened['sicd'] is None:
+            opened['image'].load()
+
+    results.append(measure('open', open_image, args.repeat))
+    image, sicd, pyramid = opened['image'], opened['sicd'], opened['pyramid']
+    width, height = image.size
+    canvas = (args.canvas_width, args.canvas_height)
+    fit = min(canvas[0] / width, canvas[1] / height)
+    centre = (width / 2, height / 2)
+
+    results.append(measure('render_fit', lambda: render(pyramid, width, height, fit, centre, canvas), args.repeat))
+
+    def zoom():
+        # wheel steps in from the fitted view to 1:1 and a little beyond
+        scale = fit
+        while scale < DELTA:
+            render(pyramid, width, height, scale, centre, canvas)
+            scale *= DELTA
+
+    results.append(measure('zoom', zoom, args.repeat))
+
+    def pan():
+        # drag across the image at 1:1 in canvas-sized steps of a quarter screen
+        for k in range(args.pan_steps):
+            x = (k * canvas[0] / 4) % max(1, width - canvas[0]) + canvas[0] / 2
+            render(pyramid, width, height, 1.0, (x, centre[1]), canvas)
+
+    results.append(measure('pan', pan, args.repeat))
+
+    annotations = Annotations()
+    annotations.extend(random_boxes(rng, width, height, args.shapes), 0, rng.integers(0, 10, args.shapes))
+    store_path = os.path.join(workdir, 'annotations.sqlite')
+    store = AnnotationStore(store_path)
+    name = os.path.basename(file_path)
+
+    def export_csv():
+        count = len(annotations)
+        shapes = [(t, label, *coords) for t, label, coords in
+                  zip(annotations.types[:count], annotations.labels[:count], annotations.clipped(width, height))]
+        store.save_image(name, shapes, size=(width, height))
+        store.export_csv(os.path.join(workdir, 'bounding_box.csv'))
+
+    results.append(measure('export_csv', export_csv, args.repeat))
+    store.close()
+
+    label_file = yolo_path(file_path)
+
+    def export_pix():
+        labels, rows = annotations.yolo(width, height)
+        write_yolo_file(label_file, labels, rows)
+
+    results.append(measure('export_pix', export_pix, args.repeat))
+    results.append(measure('import_yolo', lambda: read_yolo(label_file, width, height), args.repeat))
+
+    boxes = random_boxes(rng, width, height, args.chips)
+    chip_dirs = [os.path.join(os.path.dirname(file_path), d) for d in ('pngs', 'sicds', 'npys')]
+
+    def clear_chips():
+        for d in chip_dirs:
+            shutil.rmtree(d, ignore_errors=True)
+
+    results.append(measure('chip', lambda: write_box_chips(image, sicd, file_path, boxes, png=True, sicd=sicd is not None),
+                           args.repeat, setup=clear_chips))
+    results.append(measure('chip_npy', lambda: write_box_chips(image, sicd, file_path, boxes, png=False, npy=True),
+                           args.repeat, setup=clear_chips))
+
+    plan = grid_plan(width, height, args.grid_size)
+    grid_dirs = [f"{file_path}_png_grid", f"{file_path}_sicd_grid", f"{file_path}_npy_grid"]
+
+    def clear_grid():
+        for d in grid_dirs:
+            shutil.rmtree(d, ignore_errors=True)
+
+    results.append(measure('grid_chip', lambda: export_grid(file_path, plan, png=True, sicd=sicd is not None, remap=remap,
+                                                            data_mean=getattr(image, 'data_mean', None),
+                                                            workers=args.workers),
+                           args.repeat, setup=clear_grid))
+    for result in results:
+        result['input'] = os.path.splitext(file_path)[1].lstrip('.')
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time open, render, pan, zoom, export and chip on synthetic data.")
+    parser.add_argument('--rows', type=int, default=4096, help='image height in pixels')
+    parser.add_argument('--cols', type=int, default=4096, help='image width in pixels')
+    parser.add_argument('--formats', default='nitf,png,jpg', help='comma separated inputs to generate: nitf, png, jpg')
+    parser.add_argument('--shapes', type=int, default=1000, help='boxes exported to CSV and YOLO')
+    parser.add_argument('--chips', type=int, default=50, help='boxes written by the chip stage')
+    parser.add_argument('--grid-size', type=int, default=512)
+    parser.add_argument('--workers', type=int, default=1, help='processes for the grid chip stage')
+    parser.add_argument('--pan-steps', type=int, default=20)
+    parser.add_argument('--canvas-width', type=int, default=1600)
+    parser.add_argument('--canvas-height', type=int, default=900)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help='where inputs and outputs go, a temporary directory by default')
+    parser.add_argument('--output', default=None, help='JSON file for the results, stdout by default')
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='visionlabel-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    report = {'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+              'cpus': os.cpu_count(), 'config': vars(args), 'inputs': {}, 'results': []}
+    try:
+        for fmt in args.formats.split(','):
+            file_path = os.path.join(workdir, f"synthetic.{fmt}")
+            start = time.perf_counter()
+            if fmt in ('nitf', 'ntf'):
+                make_sicd(file_path, args.rows, args.cols, seed=args.seed)
+            else:
+                make_picture(file_path, args.cols, args.rows, seed=args.seed)
+            report['inputs'][fmt] = {'path': file_path, 'bytes': os.path.getsize(file_path),
+                                     'generate_seconds': time.perf_counter() - start}
+            report['results'].extend(bench_file(file_path, args, workdir))
+            print(f"{fmt}: done", file=sys.stderr)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    if resource is None:
+        report['max_rss_bytes'] = None
+    else:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report['max_rss_bytes'] = max_rss if sys.platform == 'darwin' else max_rss * 1024
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+import math
+from collections import OrderedDict
+from PIL import ImageTk
+from instrumentation import probe
+
+
+class CanvasTiles:
+    ''' The displayed image as fixed-size screen tiles with an LRU of their PhotoImages per zoom
+
+    Tiles are aligned to the image origin at the current zoom, so panning only
+    renders the tiles it exposes and zooming back to an earlier scale reuses
+    what is still cached. Canvas image items are recycled from a free list
+    instead of being created for every redraw, which keeps the item count at
+    the number of visible tiles.
+    '''
+
+    def __init__(self, canvas, tile_size=256, max_tiles=512):
+        self.canvas = canvas
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.photos = OrderedDict()  # (scale, col, row, fast) -> PhotoImage
+        self.shown = {}  # (col, row) -> (canvas item, photo key, PhotoImage)
+        self.free = []
+
+    def reset(self):
+        ''' Forget every tile, for a new image '''
+        for col_row in list(self.shown):
+            self._recycle(col_row)
+        self.photos.clear()
+
+    def _recycle(self, col_row):
+        item = self.shown.pop(col_row)[0]
+        self.canvas.itemconfigure(item, state='hidden')
+        self.free.append(item)
+
+    def _photo(self, pyramid, scale, col, row, image_size, fast):
+        ''' (key, PhotoImage) of a tile, preferring a full quality copy even when a fast one is asked for '''
+        scale_key = round(scale, 9)
+        for key in ((scale_key, col, row, False), (scale_key, col, row, True) if fast else None):
+            if key is not None and key in self.photos:
+                self.photos.move_to_end(key)
+                return key, self.photos[key]
+        size = self.tile_size
+        width, height = image_size
+        # edge tiles stop at the image border
+        tile_width = min(size, math.ceil(width * scale) - col * size)
+        tile_height = min(size, math.ceil(height * scale) - row * size)
+        box = (col * size / scale, row * size / scale,
+               min(width, (col * size + tile_width) / scale), min(height, (row * size + tile_height) / scale))
+        with probe.stage('crop'):
+            image = pyramid.crop(box, scale, (tile_width, tile_height), fast=fast)
+        probe.count('tile bytes', image.width * image.height * len(image.getbands()))
+        with probe.stage('photoimage'):
+            photo = ImageTk.PhotoImage(image)
+        key = (scale_key, col, row, fast)
+        self.photos[key] = photo
+        # shown tiles keep their own reference, so evicting one never blanks the screen
+        while len(self.photos) > self.max_tiles:
+            self.photos.popitem(last=False)
+        return key, photo
+
+    def render(self, pyramid, scale, origin, view, image_size, fast=False):
+        ''' Show the tiles of the image, placed at canvas origin, that overlap the canvas view box '''
+        size = self.tile_size
+        cols = math.ceil(image_size[0] * scale / size)
+        rows = math.ceil(image_size[1] * scale / size)
+        col1 = max(0, math.floor((view[0] - origin[0]) / size))
+        row1 = max(0, math.floor((view[1] - origin[1]) / size))
+        col2 = min(cols - 1, math.floor((view[2] - origin[0]) / size))
+        row2 = min(rows - 1, math.floor((view[3] - origin[1]) / size))
+        visible = {(col, row) for col in range(col1, col2 + 1) for row in range(row1, row2 + 1)}
+        scale_key = round(scale, 9)
+        for col_row, (_, key, _) in list(self.shown.items()):
+            if col_row not in visible or key[0] != scale_key:
+                self._recycle(col_row)
+        for col, row in visible:
+            key, photo = self._photo(pyramid, scale, col, row, image_size, fast)
+            shown = self.shown.get((col, row))
+            if shown is not None and shown[1] == key:
+                continue
+            if shown is not None:
+                item = shown[0]
+            elif self.free:
+                item = self.free.pop()
+            else:
+                item = self.canvas.create_image(0, 0, anchor='nw', tags="tile")
+            self.canvas.itemconfigure(item, image=photo, state='normal')
+            self.canvas.coords(item, origin[0] + col * size, origin[1] + row * size)
+            self.shown[(col, row)] = (item, key, photo)
+        self.canvas.tag_lower("tile")  # keep the image under the shapes
@@ -0,0 +1,117 @@
+import io
+import os
+import glob
+import json
+import time
+import tarfile
+import zlib
+
+SHARD_BYTES = 1 << 30  # default cap on the size of one shard
+
+
+def shard_dir(file_path):
+    ''' The output directory chips of file_path are sharded into when no other is given '''
+    return f"{os.path.dirname(file_path)}/{os.path.basename(file_path)}_shards"
+
+
+def shard_prefix(file_path):
+    ''' Shard name prefix of a source, its stem plus a hash of its path so sources with one name never collide '''
+    stem = os.path.basename(file_path).split('.')[0]
+    return f"{stem}-{zlib.crc32(os.path.abspath(file_path).encode()):08x}"
+
+
+def remove_shards(directory, prefix):
+    ''' Delete the shards and indexes an earlier export left under prefix, so a rerun never duplicates chips '''
+    for path in glob.glob(os.path.join(glob.escape(directory), glob.escape(prefix) + '-*.tar*')):
+        os.remove(path)
+
+
+def chip_meta(file_path, row, col, box):
+    ''' What the index records for one chip, row and col are None for drawn boxes '''
+    return {'source': os.path.abspath(file_path), 'row': row, 'col': col, 'bounds': [int(v) for v in box]}
+
+
+class ShardWriter:
+    ''' Streams chips into size-capped tar shards laid out WebDataset style
+
+    A chip is one sample: the members {key}.png, {key}.nitf, ... plus
+    {key}.json with the chip_meta of the sample. Once a shard passes max_bytes
+    it is closed and the next one started. Next to every {prefix}-NNNNN.tar
+    goes {prefix}-NNNNN.tar.json, its index of the samples with their
+    metadata and the (offset, size) of each member in the tar, so a loader
+    can seek straight to a chip. Shards are written under a .part name and
+    renamed when complete. Writers with different prefixes never share a
+    file, which is what lets every process write its own shards in parallel.
+    '''
+
+    def __init__(self, directory, prefix, max_bytes=SHARD_BYTES):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.shard = -1
+        self.tar = None
+        self.samples = []
+        self.paths = []  # completed shards
+        os.makedirs(directory, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _path(self):
+        return os.path.join(self.directory, f"{self.prefix}-{self.shard:05d}.tar")
+
+    def _open(self):
+        self.shard += 1
+        self.tar = tarfile.open(self._path() + '.part', 'w', format=tarfile.GNU_FORMAT)
+        self.samples = []
+
+    def _finish(self):
+        path = self._path()
+        self.tar.close()
+        self.tar = None
+        with open(path + '.json.part', 'w') as f:
+            json.dump({'shard': os.path.basename(path), 'samples': self.samples}, f)
+        os.replace(path + '.json.part', path + '.json')
+        os.replace(path + '.part', path)
+        self.paths.append(path)
+
+    def _add(self, name, data):
+        ''' Append one member, returning the (offset, size) of its data in the tar '''
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info, io.BytesIO(data))
+        # the data ends the member, padded to a whole block
+        return self.tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE, len(data)
+
+    def write(self, key, meta, members):
+        ''' Add the sample key with its meta and members, a dict of extension -> encoded bytes '''
+        meta_bytes = json.dumps(meta).encode()
+        size = sum(len(data) for data in members.values()) + len(meta_bytes)
+        if self.tar is not None and self.samples and self.tar.offset + size > self.max_bytes:
+            self._finish()
+        if self.tar is None:
+            self._open()
+        sample = dict(meta, key=key, members={})
+        for ext, data in list(members.items()) + [('json', meta_bytes)]:
+            sample['members'][ext] = self._add(f"{key}.{ext}", data)
+        self.samples.append(sample)
+
+    def close(self):
+        ''' Finish the last shard, returning the paths of every shard written '''
+        if self.tar is not None:
+            self._finish()
+        return self.paths
+
+    def abort(self):
+        ''' Drop the shard in progress, keeping the completed ones '''
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+            os.remove(self._path() + '.part')
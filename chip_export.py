@@ -0,0 +1,570 @@
+import io
+import os
+import json
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from contextlib import nullcontext
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from sarpy.io.complex.sicd import SICDReader, SICDWriter
+from sarpy.visualization.remap import Density
+from remap_stream import RemapLUT, subsample_data_mean
+from image_sources import PictureSource
+from annotations import yolo_lines
+from chip_archive import ShardWriter, SHARD_BYTES, shard_prefix, remove_shards, chip_meta
+
+# per-process state set up once by _init_worker, so tiles only carry their bounds
+_worker = {}
+# in-process exports share _worker, e.g. two grid exports on different export writer lanes
+_worker_lock = threading.Lock()
+POOL_PIXELS_PER_WORKER = 32 << 20  # tile pixels it takes to pay for spawning a worker that imports sarpy and reopens the file
+
+
+def grid_plan(width, height, grid_size):
+    ''' Every tile of the chip grid as (row, col, (left, upper, right, lower))
+
+    Tiles step by half the grid size. When the image is not a multiple of the
+    half step, one more column and row are aligned to the right and bottom
+    edges, so the whole image is covered. Images smaller than one tile give
+    an empty plan.
+    '''
+    sub_grid = grid_size // 2
+    if sub_grid == 0 or width < grid_size or height < grid_size:
+        return []
+    w_, h_ = width // sub_grid, height // sub_grid
+    lefts = [i * sub_grid for i in range(w_ - 1)]
+    uppers = [j * sub_grid for j in range(h_ - 1)]
+    if width % sub_grid != 0:
+        lefts.append(width - grid_size)
+    if height % sub_grid != 0:
+        uppers.append(height - grid_size)
+    return [(j, i, (left, upper, left + grid_size, upper + grid_size))
+            for j, upper in enumerate(uppers) for i, left in enumerate(lefts)]
+
+
+def sample_plan(width, height, boxes, chip_size, per_box=1, jitter=0.0, negative_ratio=0.0, rng=None, attempts=20):
+    ''' Chips of chip_size around labelled boxes plus random negatives, as (positive, (left, upper, right, lower))
+
+    Positives are centred on a box, or with a jitter in (0, 1] shifted at
+    random by up to that fraction of the room the box has inside the chip, so
+    a box that fits the chip stays whole. negative_ratio negatives per
+    positive are placed uniformly, rejecting any that touch a box; fewer come
+    back when the image has no room for them. Chips are kept inside the image
+    and images smaller than one chip give an empty plan.
+    '''
+    if width < chip_size or height < chip_size:
+        return []
+    rng = rng if rng is not None else np.random.default_rng()
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    centres = np.repeat((boxes[:, :2] + boxes[:, 2:]) / 2, per_box, axis=0)
+    room = np.maximum(0, chip_size - np.repeat(boxes[:, 2:] - boxes[:, :2], per_box, axis=0)) / 2
+    corners = np.rint(centres + jitter * rng.uniform(-1, 1, centres.shape) * room - chip_size / 2)
+    corners = np.clip(corners, 0, [width - chip_size, height - chip_size]).astype(int)
+    plan = [(True, (x, y, x + chip_size, y + chip_size)) for x, y in corners.tolist()]
+    wanted = int(round(negative_ratio * len(plan)))
+    if wanted:
+        tries = rng.integers(0, [width - chip_size + 1, height - chip_size + 1], (wanted * attempts, 2))
+        x, y = tries[:, :1], tries[:, 1:]
+        touches = ((x < boxes[:, 2]) & (x + chip_size > boxes[:, 0]) &
+                   (y < boxes[:, 3]) & (y + chip_size > boxes[:, 1])).any(axis=1)
+        plan.extend((False, (x, y, x + chip_size, y + chip_size)) for x, y in tries[~touches][:wanted].tolist())
+    return plan
+
+
+def grid_dirs(file_path):
+    ''' The (png, sicd, npy) output directories grid chipping writes next to file_path '''
+    dir_path = os.path.dirname(file_path)
+    file_name = os.path.basename(file_path)
+    return f"{dir_path}/{file_name}_png_grid", f"{dir_path}/{file_name}_sicd_grid", f"{dir_path}/{file_name}_npy_grid"
+
+
+def tile_name(file_path, row, col):
+    return f"{os.path.basename(file_path).split('.')[0]}_{row}_{col}"
+
+
+def sicd_limits(box):
+    ''' sarpy (row_limits, col_limits) of an image-space (left, upper, right, lower) box '''
+    left, upper, right, lower = [int(v) for v in box]
+    # image y runs along SICD rows and image x along columns
+    return (upper, lower), (left, right)
+
+
+class RowBuffer:
+    ''' Rolling buffer of complex source rows for boxes visited in order of their upper edge
+
+    Rows shared by consecutive boxes (the overlap of a chip grid, or stacked
+    drawn boxes) are kept instead of being read again, so a sorted pass over
+    the boxes reads every source row once.
+    '''
+
+    def __init__(self, reader, col_limits):
+        self.reader = reader
+        self.col_limits = col_limits
+        self.buffer = None
+        self.top = self.bottom = 0  # buffer holds source rows [top, bottom)
+
+    def window(self, box):
+        (upper, lower), (left, right) = sicd_limits(box)
+        if upper < self.top or upper >= self.bottom:
+            self.top = self.bottom = upper
+        elif upper > self.top:
+            # slide the rows still needed to the start of the buffer
+            kept = self.bottom - upper
+            self.buffer[:kept] = self.buffer[upper - self.top:self.bottom - self.top]
+            self.top = upper
+        if lower > self.bottom:
+            if self.buffer is None or self.buffer.shape[0] < lower - self.top:
+                grown = np.empty((lower - self.top, self.col_limits[1] - self.col_limits[0]), dtype=np.complex64)
+                if self.bottom > self.top:
+                    grown[:self.bottom - self.top] = self.buffer[:self.bottom - self.top]
+                self.buffer = grown
+            self.buffer[self.bottom - self.top:lower - self.top] = \
+                self.reader[self.bottom:lower, self.col_limits[0]:self.col_limits[1]]
+            self.bottom = lower
+        return self.buffer[upper - self.top:lower - self.top, left - self.col_limits[0]:right - self.col_limits[0]]
+
+
+def chip_sicd_meta(reader):
+    ''' The reader's SICD structure prepared the way chip_sicd.create_chip prepares it '''
+    sicd = reader.get_sicds_as_tuple()[0]
+    # conversion_utility stamps the suggested name into the NITF header before subsetting
+    suggested_name = sicd.get_suggested_name(1)
+    sicd.NITF['SUGGESTED_NAME'] = (suggested_name or 'Unknown0') + '_SICD'
+    return sicd
+
+
+def chip_file_name(reader, row_limits, col_limits):
+    ''' The output name chip_sicd.create_chip gives a chip when no output_file is passed '''
+    stem, ext = os.path.splitext(os.path.basename(reader.file_name))
+    image_data = reader.sicd_meta.ImageData
+    return (f"{stem}_{image_data.FirstRow + row_limits[0]:d}-{image_data.FirstRow + row_limits[1]:d}"
+            f"_{image_data.FirstCol + col_limits[0]:d}-{image_data.FirstCol + col_limits[1]:d}{ext}")
+
+
+def write_sicd_chip(sicd, data, box, output_path):
+    ''' Write data, the pixels of box, as a SICD chip with the same metadata create_chip produces '''
+    row_limits, col_limits = sicd_limits(box)
+    chip_meta = sicd.create_subset_structure(row_limits, col_limits)[0]
+    writer = SICDWriter(output_path, chip_meta, check_older_version=False, check_existence=False)
+    try:
+        writer.write_chip(data, start_indices=(0, 0))
+    finally:
+        writer.close()
+
+
+def complex_view(reader):
+    ''' Zero-copy complex (rows, cols) memory map of a SICD, None when its pixels need converting on read
+
+    Uncompressed RE32F_IM32F pixels are interleaved float32 pairs, which is
+    exactly the layout of complex64 in the file's byte order.
+    '''
+    segment = reader.data_segment
+    array = getattr(segment, 'underlying_array', None)
+    if not isinstance(array, np.memmap) or segment.reverse_axes or segment.transpose_axes:
+        return None
+    if array.dtype.kind != 'f' or array.itemsize != 4 or array.shape != tuple(reader.data_size[:2]) + (2,):
+        return None
+    return array.view(np.dtype(np.complex64).newbyteorder(array.dtype.byteorder))[..., 0]
+
+
+def npy_data(data, kind):
+    ''' SICD samples as a .npy chip stores them, complex as read or the detected float32 amplitude '''
+    return np.abs(data) if kind == 'amplitude' else data
+
+
+def npy_meta(data, kind):
+    ''' What the sidecar records about a .npy chip, the dtype keeps the byte order of the source '''
+    return {'dtype': data.dtype.str, 'shape': list(data.shape), 'data': kind}
+
+
+def npy_bytes(data):
+    buffer = io.BytesIO()
+    np.save(buffer, data)
+    return buffer.getvalue()
+
+
+def write_npy_chip(data, output_path):
+    ''' Save data through a temporary name, np.save streams strided memory map slices without copying them whole '''
+    with open(output_path + '.part', 'wb') as f:
+        np.save(f, data)
+    os.replace(output_path + '.part', output_path)
+
+
+def update_npy_sidecar(path, entries):
+    ''' Merge entries into the JSON sidecar of a .npy chip folder, keyed by file name so reruns replace their chips '''
+    chips = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            chips = {entry['file']: entry for entry in json.load(f)['chips']}
+    chips.update((entry['file'], entry) for entry in entries)
+    with open(path + '.part', 'w') as f:
+        json.dump({'chips': [chips[name] for name in sorted(chips)]}, f, indent=1)
+    os.replace(path + '.part', path)
+
+
+def png_bytes(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def sicd_chip_bytes(sicd, data, box, tmp_dir):
+    ''' The encoded SICD chip of box, SICDWriter only writes to a path so it goes through a temporary file '''
+    tmp_path = os.path.join(tmp_dir, f".{os.getpid()}-{threading.get_ident()}.part.nitf")
+    try:
+        write_sicd_chip(sicd, data, box, tmp_path)
+        with open(tmp_path, 'rb') as f:
+            return f.read()
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_sicd_chips(reader, chips):
+    ''' Write ((left, upper, right, lower), output_path) chips reading each source row once '''
+    if not chips:
+        return
+    chips = sorted(chips, key=lambda chip: chip[0][1])
+    sicd = chip_sicd_meta(reader)
+    rows = RowBuffer(reader, (min(int(box[0]) for box, _ in chips), max(int(box[2]) for box, _ in chips)))
+    for box, output_path in chips:
+        write_sicd_chip(sicd, rows.window(box), box, output_path)
+
+
+def box_npy(image, reader, view, box, kind):
+    ''' (.npy pixels, sidecar metadata) of a drawn box, a slice of the memory map when there is one '''
+    left, upper, right, lower = [int(v) for v in box]
+    if reader is None:
+        data = image.window(left, upper, right, lower, 1)
+        return data, npy_meta(data, 'pixels')
+    data = npy_data(view[upper:lower, left:right] if view is not None else reader[upper:lower, left:right], kind)
+    return data, npy_meta(data, kind)
+
+
+def shard_box_chips(image, reader, file_path, boxes, png, sicd, shard_dir, npy=False, npy_kind='complex',
+                    shard_bytes=SHARD_BYTES):
+    ''' Write the drawn boxes of file_path as samples of its chips shards in shard_dir '''
+    prefix = f"{shard_prefix(file_path)}-chips"
+    remove_shards(shard_dir, prefix)
+    boxes = sorted(([int(v) for v in box] for box in boxes), key=lambda box: box[1])
+    rows = None
+    if sicd and boxes:
+        sicd_meta = chip_sicd_meta(reader)
+        rows = RowBuffer(reader, (min(box[0] for box in boxes), max(box[2] for box in boxes)))
+    view = complex_view(reader) if npy and reader is not None else None
+    stem = os.path.basename(file_path).split('.')[0]
+    with ShardWriter(shard_dir, prefix, shard_bytes) as writer:
+        for box in boxes:
+            if box[2] <= box[0] or box[3] <= box[1]:
+                continue
+            members = {}
+            meta = chip_meta(file_path, None, None, box)
+            if png:
+                members['png'] = png_bytes(image.crop(box))
+            if sicd:
+                members['nitf'] = sicd_chip_bytes(sicd_meta, rows.window(box), box, shard_dir)
+            if npy:
+                data, meta['npy'] = box_npy(image, reader, view, box, npy_kind)
+                members['npy'] = npy_bytes(data)
+            writer.write(f"{stem}_{box[0]}-{box[2]}_{box[1]}-{box[3]}", meta, members)
+        return writer.close()
+
+
+def write_box_chips(image, reader, file_path, boxes, png=True, sicd=False, shard_dir=None, npy=False, npy_kind='complex'):
+    ''' Write the drawn (left, upper, right, lower) boxes of file_path to its pngs, sicds and npys folders, or to shards
+
+    .npy chips hold the complex samples of a SICD, or their float32 amplitude
+    when npy_kind is 'amplitude', and the 8-bit pixels of a picture. Their
+    dtype, shape and bounds go to the npys/{name}.json sidecar. A SICD passed
+    without a reader gets one of its own, so jobs on the writer threads never
+    read through the reader the app displays from.
+    '''
+    if reader is None and file_path.lower().endswith(('.ntf', '.nitf')):
+        reader = SICDReader(file_path)
+    if shard_dir is not None:
+        return shard_box_chips(image, reader, file_path, boxes, png, sicd, shard_dir, npy, npy_kind)
+    dir_path = os.path.dirname(file_path)
+    file_name = os.path.basename(file_path)
+    if npy:
+        view = complex_view(reader) if reader is not None else None
+        entries = []
+        for box in boxes:
+            left, upper, right, lower = [int(v) for v in box]
+            if right <= left or lower <= upper:
+                continue
+            name = f"{file_name.split('.')[0]}_{left}-{right}_{upper}-{lower}.npy"
+            os.makedirs(f"{dir_path}/npys", exist_ok=True)
+            data, meta = box_npy(image, reader, view, box, npy_kind)
+            write_npy_chip(data, f"{dir_path}/npys/{name}")
+            entries.append(dict(chip_meta(file_path, None, None, box), file=name, **meta))
+        if entries:
+            update_npy_sidecar(f"{dir_path}/npys/{file_name.split('.')[0]}.json", entries)
+    sicd_chips = []
+    for shape_coords in boxes:
+        if png:
+            os.makedirs(f"{dir_path}/pngs", exist_ok=True)
+            cropped_image = image.crop(shape_coords)
+            shape_coords = [int(i) for i in shape_coords]
+            cropped_image.save(f"{dir_path}/pngs/{file_name.split('.')[0]}_{shape_coords[0]}-{shape_coords[2]}_{shape_coords[1]}-{shape_coords[3]}.png")
+        if sicd:
+            row_limits, col_limits = sicd_limits(shape_coords)
+            if row_limits[1] > row_limits[0] and col_limits[1] > col_limits[0]:
+                sicd_chips.append((shape_coords, f"{dir_path}/sicds/{chip_file_name(reader, row_limits, col_limits)}"))
+    if sicd_chips:
+        # one pass over the source rows for every box instead of a read per chip
+        os.makedirs(f"{dir_path}/sicds", exist_ok=True)
+        write_sicd_chips(reader, sicd_chips)
+
+
+def tile_done(file_path, row, col, png, sicd, npy=False):
+    ''' True when every requested output of a tile is already on disk '''
+    png_dir, sicd_dir, npy_dir = grid_dirs(file_path)
+    name = tile_name(file_path, row, col)
+    return ((not png or os.path.isfile(f"{png_dir}/{name}.png")) and
+            (not sicd or os.path.isfile(f"{sicd_dir}/{name}.nitf")) and
+            (not npy or os.path.isfile(f"{npy_dir}/{name}.npy")))
+
+
+def _init_worker(file_path, png, sicd, remap, data_mean, skip_existing=False, picture_cache_dir=None, shard_dir=None,
+                 shard_bytes=SHARD_BYTES, npy=False, npy_kind='complex'):
+    _worker.clear()
+    _worker.update(file_path=file_path, png=png, sicd=sicd, skip_existing=skip_existing, shard_dir=shard_dir,
+                   shard_bytes=shard_bytes, npy=npy, npy_kind=npy_kind)
+    _worker['png_dir'], _worker['sicd_dir'], _worker['npy_dir'] = grid_dirs(file_path)
+    if file_path.lower().endswith(('.ntf', '.nitf')):
+        _worker['reader'] = SICDReader(file_path)
+        _worker['sicd_meta'] = chip_sicd_meta(_worker['reader'])
+        _worker['rows'] = RowBuffer(_worker['reader'], (0, _worker['reader'].data_size[1]))
+        _worker['view'] = complex_view(_worker['reader']) if npy else None
+        if png:
+            if data_mean is None:
+                data_mean = subsample_data_mean(_worker['reader'])
+            _worker['lut'] = RemapLUT(remap if remap is not None else Density(), data_mean)
+    else:
+        # large pictures are read through the memory-mapped raster when one is cached
+        image = PictureSource.open(file_path, cache_dir=picture_cache_dir)
+        image.load()
+        _worker['image'] = image
+
+
+def _crop(box):
+    if 'image' in _worker:
+        return _worker['image'].crop(box)
+    return Image.fromarray(_worker['lut'](_worker['rows'].window(box)))
+
+
+def _npy(box):
+    ''' (.npy pixels, metadata) of a tile, sliced from the memory map or the row buffer without another read '''
+    left, upper, right, lower = [int(v) for v in box]
+    if 'image' in _worker:
+        data = _worker['image'].window(left, upper, right, lower, 1)
+        return data, npy_meta(data, 'pixels')
+    view = _worker['view']
+    data = npy_data(view[upper:lower, left:right] if view is not None else _worker['rows'].window(box), _worker['npy_kind'])
+    return data, npy_meta(data, _worker['npy_kind'])
+
+
+def _export_tile(tile, entries):
+    row, col, box = tile
+    name = tile_name(_worker['file_path'], row, col)
+    skip = _worker['skip_existing']
+    # write under a temporary name and rename, so an interrupted run never leaves a truncated tile behind
+    png_path = f"{_worker['png_dir']}/{name}.png"
+    if _worker['png'] and not (skip and os.path.isfile(png_path)):
+        _crop(box).save(f"{_worker['png_dir']}/{name}.part.png")
+        os.replace(f"{_worker['png_dir']}/{name}.part.png", png_path)
+    sicd_path = f"{_worker['sicd_dir']}/{name}.nitf"
+    if _worker['sicd'] and not (skip and os.path.isfile(sicd_path)):
+        write_sicd_chip(_worker['sicd_meta'], _worker['rows'].window(box), box, f"{_worker['sicd_dir']}/{name}.part.nitf")
+        os.replace(f"{_worker['sicd_dir']}/{name}.part.nitf", sicd_path)
+    npy_path = f"{_worker['npy_dir']}/{name}.npy"
+    if _worker['npy'] and not (skip and os.path.isfile(npy_path)):
+        data, meta = _npy(box)
+        write_npy_chip(data, npy_path)
+        entries.append(dict(chip_meta(_worker['file_path'], row, col, box), file=f"{name}.npy", **meta))
+    return name
+
+
+def _shard_tile(writer, tile):
+    row, col, box = tile
+    name = tile_name(_worker['file_path'], row, col)
+    members = {}
+    meta = chip_meta(_worker['file_path'], row, col, box)
+    if _worker['png']:
+        members['png'] = png_bytes(_crop(box))
+    if _worker['sicd']:
+        members['nitf'] = sicd_chip_bytes(_worker['sicd_meta'], _worker['rows'].window(box), box, writer.directory)
+    if _worker['npy']:
+        data, meta['npy'] = _npy(box)
+        members['npy'] = npy_bytes(data)
+    writer.write(name, meta, members)
+    return name
+
+
+def _export_tiles(tiles, run=0):
+    ''' (tile names, .npy sidecar entries) of a run of tiles '''
+    # tiles arrive as runs of whole grid rows, so the row buffer reads each source row once per run
+    entries = []
+    if _worker['shard_dir'] is None:
+        return [_export_tile(tile, entries) for tile in tiles], entries
+    # every run streams into its own shards, so the workers never share a file
+    prefix = f"{shard_prefix(_worker['file_path'])}-grid-{run:03d}"
+    with ShardWriter(_worker['shard_dir'], prefix, _worker['shard_bytes']) as writer:
+        return [_shard_tile(writer, tile) for tile in tiles], entries
+
+
+def export_samples(file_path, samples, output_dir, png=True, npy=False, npy_kind='complex', remap=None, shard_dir=None,
+                   shard_bytes=SHARD_BYTES, picture_cache_dir=None):
+    ''' Write sampled chips of file_path with their YOLO labels in this process, returning the chip names
+
+    samples are (name, box, labels, rows) with rows already in chip YOLO
+    coordinates. Chips go to output_dir/images, .npy arrays to output_dir/npys
+    and labels to output_dir/labels, the layout YOLO trainers read; with a
+    shard_dir every chip is instead one sample of the source's samples shards,
+    its labels a .txt member. Sampled chips are scattered, so SICD windows are
+    read on their own instead of through a full-width row buffer.
+    '''
+    if file_path.lower().endswith(('.ntf', '.nitf')):
+        image, reader = None, SICDReader(file_path)
+        view = complex_view(reader)
+        if png:
+            lut = RemapLUT(remap if remap is not None else Density(), subsample_data_mean(reader))
+    else:
+        image = PictureSource.open(file_path, cache_dir=picture_cache_dir)
+        image.load()
+    writer = None
+    if shard_dir is not None:
+        prefix = f"{shard_prefix(file_path)}-samples"
+        remove_shards(shard_dir, prefix)
+        writer = ShardWriter(shard_dir, prefix, shard_bytes)
+    else:
+        for sub_dir in ('images', 'labels', 'npys') if npy else ('images', 'labels'):
+            os.makedirs(f"{output_dir}/{sub_dir}", exist_ok=True)
+    names, entries = [], []
+    with writer if writer is not None else nullcontext():
+        # in row order, so consecutive windows share pages of the source
+        for name, box, labels, rows in sorted(samples, key=lambda sample: sample[1][1]):
+            left, upper, right, lower = box
+            meta = chip_meta(file_path, None, None, box)
+            if image is None:
+                data = view[upper:lower, left:right] if view is not None else reader[upper:lower, left:right]
+            chip = None
+            if png:
+                chip = image.crop(box) if image is not None else Image.fromarray(lut(data))
+            pixels = None
+            if npy:
+                if image is not None:
+                    pixels = image.window(left, upper, right, lower, 1)
+                    npy_info = npy_meta(pixels, 'pixels')
+                else:
+                    pixels = npy_data(data, npy_kind)
+                    npy_info = npy_meta(pixels, npy_kind)
+            if writer is not None:
+                members = {'txt': yolo_lines(labels, rows).encode()}
+                if chip is not None:
+                    members['png'] = png_bytes(chip)
+                if pixels is not None:
+                    meta['npy'] = npy_info
+                    members['npy'] = npy_bytes(pixels)
+                writer.write(name, meta, members)
+            else:
+                if chip is not None:
+                    chip.save(f"{output_dir}/images/{name}.part.png")
+                    os.replace(f"{output_dir}/images/{name}.part.png", f"{output_dir}/images/{name}.png")
+                if pixels is not None:
+                    write_npy_chip(pixels, f"{output_dir}/npys/{name}.npy")
+                    entries.append(dict(meta, file=f"{name}.npy", **npy_info))
+                with open(f"{output_dir}/labels/{name}.txt", 'w') as f:
+                    f.write(yolo_lines(labels, rows))
+            names.append(name)
+    if entries:
+        update_npy_sidecar(f"{output_dir}/npys/{shard_prefix(file_path)}.json", entries)
+    return names
+
+
+def row_runs(plan, runs):
+    ''' Split plan into at most runs lists of consecutive grid rows '''
+    grid_rows = sorted({tile[0] for tile in plan})
+    per_run = max(1, -(-len(grid_rows) // runs))
+    groups = [set(grid_rows[k:k + per_run]) for k in range(0, len(grid_rows), per_run)]
+    return [[tile for tile in plan if tile[0] in group] for group in groups]
+
+
+def export_grid(file_path, plan, png=True, sicd=False, remap=None, data_mean=None, workers=None, skip_existing=False,
+                picture_cache_dir=None, shard_dir=None, shard_bytes=SHARD_BYTES, npy=False, npy_kind='complex'):
+    ''' Write the tiles of plan for file_path on a process pool, returning the tile names
+
+    Each worker opens the file once and then only receives tile bounds.
+    workers=None sizes the pool to the grid, one worker per
+    POOL_PIXELS_PER_WORKER tile pixels up to the core count, so small grids
+    never pay for spawning processes. SICD
+    tiles written to PNG are remapped with data_mean, the mean of the whole
+    image, so they match what is shown on the canvas. With skip_existing,
+    outputs already on disk are left alone, which makes reruns resume. With a
+    picture_cache_dir, large pictures are decoded once into a memory map that
+    every worker shares instead of each holding its own decoded copy; without
+    one, a pool uses a temporary directory for it. With a
+    shard_dir, tiles are streamed into size-capped tar shards there instead of
+    one file each, replacing the shards of an earlier export of file_path;
+    skip_existing does not apply to them. With npy, tiles are also saved as
+    .npy arrays, see write_box_chips, listed in {file}_npy_grid/{name}.json.
+    '''
+    png_dir, sicd_dir, npy_dir = grid_dirs(file_path)
+    if shard_dir is not None:
+        remove_shards(shard_dir, f"{shard_prefix(file_path)}-grid")
+    else:
+        if png:
+            os.makedirs(png_dir, exist_ok=True)
+        if sicd:
+            os.makedirs(sicd_dir, exist_ok=True)
+        if npy:
+            os.makedirs(npy_dir, exist_ok=True)
+    if skip_existing and shard_dir is None:
+        plan = [tile for tile in plan if not tile_done(file_path, tile[0], tile[1], png, sicd, npy)]
+    if not plan or not (png or sicd or npy):
+        return []
+    if workers is None:
+        # a small grid finishes in one process before a pool has even started
+        pixels = sum((box[2] - box[0]) * (box[3] - box[1]) for _, _, box in plan)
+        workers = min(os.cpu_count() or 1, max(1, pixels // POOL_PIXELS_PER_WORKER))
+    workers = min(workers, len(plan))
+    shared_dir = None
+    if workers > 1 and picture_cache_dir is None and not file_path.lower().endswith(('.ntf', '.nitf')):
+        # decode once into a temporary memory map the workers share, not a decoded copy per worker
+        shared_dir = picture_cache_dir = tempfile.mkdtemp(prefix='visionlabel-grid-')
+    initargs = (file_path, png, sicd, remap, data_mean, skip_existing, picture_cache_dir, shard_dir, shard_bytes, npy,
+                npy_kind)
+    if workers == 1:
+        # a single worker is not worth the process start-up
+        with _worker_lock:
+            _init_worker(*initargs)
+            try:
+                results = [_export_tiles(plan)]
+            finally:
+                _worker.clear()
+    else:
+        try:
+            results = _export_pool(file_path, plan, workers, initargs, picture_cache_dir)
+        finally:
+            if shared_dir is not None:
+                shutil.rmtree(shared_dir, ignore_errors=True)
+    entries = [entry for _, run_entries in results for entry in run_entries]
+    if entries:
+        # the workers only report their chips, the sidecar is written once here
+        update_npy_sidecar(f"{npy_dir}/{os.path.basename(file_path).split('.')[0]}.json", entries)
+    return [name for names, _ in results for name in names]
+
+
+def _export_pool(file_path, plan, workers, initargs, picture_cache_dir):
+    if picture_cache_dir and not file_path.lower().endswith(('.ntf', '.nitf')):
+        PictureSource.open(file_path, cache_dir=picture_cache_dir).load()  # decode once, before the workers map it
+    # spawn so the workers do not inherit Tk or the prefetch threads
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=initargs) as executor:
+        # a few runs per worker balances load while only re-reading the overlap at run boundaries
+        runs = row_runs(plan, workers * 4)
+        return list(executor.map(_export_tiles, runs, range(len(runs))))
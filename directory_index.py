@@ -0,0 +1,131 @@
+import os
+from bisect import bisect_left
+from annotations import yolo_path
+
+REBUILD_CHANGES = 256  # refreshes with more added or removed files than this rebuild the index instead
+
+
+class DirectoryIndex:
+    ''' Sorted image paths of one directory with O(1) positions and their YOLO sidecar files
+
+    The directory is read once with os.scandir. Files the app adds or deletes
+    itself are patched in place, and refresh() only rereads the directory
+    when its modification time shows someone else changed it, then patches in
+    just the images and label files that appeared or disappeared.
+    '''
+
+    def __init__(self, directory, extension):
+        self.directory = directory
+        self.extension = extension
+        self.paths = []
+        self.positions = {}
+        self.names = set()
+        self.stems = set()  # stems of the .txt files in the directory
+        self.labels = {}  # image path -> label path, for images that have one
+        self.mtime_ns = None
+        self.scan()
+
+    def path(self, name):
+        return f"{self.directory}/{name}"
+
+    def _read(self):
+        ''' (image names, .txt stems, directory mtime) from one pass over the directory '''
+        names, stems = set(), set()
+        with os.scandir(self.directory) as entries:
+            stat = os.stat(self.directory)
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith(self.extension):
+                    names.add(entry.name)
+                if entry.name.endswith(".txt"):
+                    stems.add(entry.name[:-4])
+        return names, stems, stat.st_mtime_ns
+
+    def scan(self):
+        ''' Read the directory, keeping self.paths as the same list object '''
+        self._build(*self._read())
+
+    def _build(self, names, stems, mtime_ns):
+        self.paths[:] = [self.path(name) for name in sorted(names)]
+        self.positions = {path: k for k, path in enumerate(self.paths)}
+        self.names, self.stems = names, stems
+        self.labels = {self.path(name): self.path(os.path.splitext(name)[0] + ".txt")
+                       for name in names if os.path.splitext(name)[0] in stems}
+        self.mtime_ns = mtime_ns
+
+    def refresh(self):
+        ''' Apply what changed on disk since the last read, returning whether the directory changed '''
+        if os.stat(self.directory).st_mtime_ns == self.mtime_ns:
+            return False
+        names, stems, mtime_ns = self._read()
+        added, removed = names - self.names, self.names - names
+        if len(added) + len(removed) > REBUILD_CHANGES:
+            self._build(names, stems, mtime_ns)
+            return True
+        # patch the sorted list and renumber once, from the first position that moved
+        start = len(self.paths)
+        if removed:
+            removed = {self.path(name) for name in removed}
+            start = min(self.positions.pop(path) for path in removed)
+            self.paths[start:] = [path for path in self.paths[start:] if path not in removed]
+            for path in removed:
+                self.labels.pop(path, None)
+        for name in sorted(added):
+            k = bisect_left(self.paths, self.path(name))
+            self.paths.insert(k, self.path(name))
+            start = min(start, k)
+        self._renumber(start)
+        self.names = names
+        for stem in stems ^ self.stems:
+            image = self.path(stem + self.extension)
+            if stem in stems and image in self.positions:
+                self.labels[image] = self.path(stem + ".txt")
+            else:
+                self.labels.pop(image, None)
+        for name in added:
+            stem = os.path.splitext(name)[0]
+            if stem in stems:
+                self.labels[self.path(name)] = self.path(stem + ".txt")
+        self.stems = stems
+        self.mtime_ns = mtime_ns
+        return True
+
+    def position(self, path):
+        return self.positions[path]
+
+    def label_path(self, path):
+        ''' The sidecar label file of path, or None when it has none
+
+        Checked on disk, so label files another tool wrote or deleted since the
+        last read are seen without refreshing the whole directory.
+        '''
+        label = self.labels.get(path) or yolo_path(path)
+        if os.path.isfile(label):
+            self.labels[path] = label
+            return label
+        self.labels.pop(path, None)
+        return None
+
+    def set_label(self, path, label_path):
+        self.labels[path] = label_path
+
+    def _renumber(self, start):
+        for k in range(start, len(self.paths)):
+            self.positions[self.paths[k]] = k
+
+    def add(self, path):
+        if path in self.positions:
+            return
+        k = bisect_left(self.paths, path)
+        self.paths.insert(k, path)
+        self.names.add(os.path.basename(path))
+        self._renumber(k)
+
+    def remove(self, path):
+        ''' Forget a deleted image and its label, shifting the positions after it '''
+        k = self.positions.pop(path)
+        self.labels.pop(path, None)
+        self.names.discard(os.path.basename(path))
+        del self.paths[k]
+        self._renumber(k)
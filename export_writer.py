@@ -0,0 +1,54 @@
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class ExportWriter:
+    ''' Runs export writes on background threads, in submission order for each key
+
+    A key (an output file or store path) always goes to the same single-thread
+    lane, so writes to one file never overtake each other while different files
+    are written in parallel. Jobs must only use the snapshot they are given,
+    never live app or Tk state. Failures are printed and kept in errors.
+    '''
+
+    def __init__(self, lanes=2):
+        self.lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix='export') for _ in range(lanes)]
+        self.pending = {}  # future -> key
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        lane = self.lanes[zlib.crc32(str(key).encode()) % len(self.lanes)]
+        future = lane.submit(fn, *args, **kwargs)
+        with self.lock:
+            self.pending[future] = key
+
+        def done(future):
+            with self.lock:
+                self.pending.pop(future, None)
+                if not future.cancelled() and future.exception() is not None:
+                    self.errors.append((key, future.exception()))
+                    print(f"Export failed for {key}: {future.exception()}")
+        future.add_done_callback(done)
+        return future
+
+    def wait(self, key):
+        ''' Wait for the writes queued for key, e.g. before reading back the file they write '''
+        with self.lock:
+            pending = [future for future, pending_key in self.pending.items() if pending_key == key]
+        wait(pending)
+
+    def flush(self):
+        ''' Wait for everything queued so far, returning the failures since the last flush '''
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+        with self.lock:
+            errors, self.errors = self.errors, []
+        return errors
+
+    def close(self):
+        self.flush()
+        for lane in self.lanes:
+            lane.shutdown(wait=True)
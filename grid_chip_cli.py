@@ -0,0 +1,89 @@
+''' Headless grid chipping of whole directory trees
+
+Writes the same {file}_png_grid / {file}_sicd_grid / {file}_npy_grid tiles as "Export Chip Grid"
+in the app, for every matching file below a directory. Tiles already on disk
+are skipped, so an interrupted run can simply be started again. With
+--shards, the tiles of every file are streamed into size-capped tar shards in
+one directory instead; those are rewritten on a rerun.
+
+    python grid_chip_cli.py /data/scenes --grid-size 512 --png --sicd --workers 16
+    python grid_chip_cli.py /data/scenes --png --shards /data/scene_shards --shard-mb 1024
+'''
+import os
+import sys
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image
+from sarpy.io.complex.sicd import SICDReader
+from chip_export import grid_plan, export_grid
+from chip_archive import SHARD_BYTES
+
+SAR_EXTENSIONS = ('.ntf', '.nitf')
+PICTURE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def find_images(directory, extensions):
+    ''' Sorted paths of every image below directory, ignoring grid output folders '''
+    paths = []
+    for dir_path, dir_names, file_names in os.walk(directory):
+        dir_names[:] = sorted(d for d in dir_names if not d.endswith(('_png_grid', '_sicd_grid', '_npy_grid', '_shards')))
+        paths.extend(os.path.join(dir_path, f) for f in sorted(file_names) if f.lower().endswith(extensions))
+    return paths
+
+
+def image_size(file_path):
+    ''' (width, height) without decoding the pixels '''
+    if file_path.lower().endswith(SAR_EXTENSIONS):
+        rows, cols = SICDReader(file_path).data_size[:2]
+        return cols, rows
+    with Image.open(file_path) as image:
+        return image.size
+
+
+def chip_file(file_path, grid_size, png, sicd, shard_dir=None, shard_bytes=SHARD_BYTES, npy=False, npy_kind='complex'):
+    ''' Grid chip one file in this process, returning (file_path, tiles planned, tiles written) '''
+    is_sar = file_path.lower().endswith(SAR_EXTENSIONS)
+    plan = grid_plan(*image_size(file_path), grid_size)
+    written = export_grid(file_path, plan, png=png, sicd=sicd and is_sar, workers=1, skip_existing=True,
+                          shard_dir=shard_dir, shard_bytes=shard_bytes, npy=npy, npy_kind=npy_kind)
+    return file_path, len(plan), len(written)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grid chip every image below a directory.")
+    parser.add_argument('directory')
+    parser.add_argument('-g', '--grid-size', type=int, default=512, help='chip size in pixels, chips overlap by half')
+    parser.add_argument('--png', action='store_true', help='write {file}_png_grid chips')
+    parser.add_argument('--sicd', action='store_true', help='write {file}_sicd_grid chips (SICD inputs only)')
+    parser.add_argument('--npy', action='store_true', help='write {file}_npy_grid .npy chips, complex for SICD inputs')
+    parser.add_argument('--amplitude', action='store_true', help='save the float32 amplitude of SICDs to .npy instead')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='processes, default every core')
+    parser.add_argument('--sar-only', action='store_true', help='ignore jpg/jpeg/png inputs')
+    parser.add_argument('--shards', default=None, help='write tar shards of the chips to this directory instead')
+    parser.add_argument('--shard-mb', type=int, default=SHARD_BYTES >> 20, help='size cap of one shard in MB')
+    args = parser.parse_args(argv)
+    if not (args.png or args.sicd or args.npy):
+        parser.error('nothing to write, pass --png, --sicd and/or --npy')
+
+    extensions = SAR_EXTENSIONS if args.sar_only else SAR_EXTENSIONS + PICTURE_EXTENSIONS
+    paths = find_images(args.directory, extensions)
+    print(f"{len(paths)} images under {args.directory}")
+    failures = 0
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+        futures = {executor.submit(chip_file, path, args.grid_size, args.png, args.sicd, args.shards,
+                                   args.shard_mb << 20, args.npy, 'amplitude' if args.amplitude else 'complex'): path
+                   for path in paths}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                file_path, planned, written = future.result()
+                print(f"[{done}/{len(paths)}] {file_path}: {written} written, {planned - written} already done")
+            except Exception as e:
+                failures += 1
+                print(f"[{done}/{len(paths)}] {futures[future]}: failed, {e}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
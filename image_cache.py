@@ -0,0 +1,96 @@
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+
+# bytes per band for the PIL modes the app can end up displaying
+MODE_BYTES = {'I': 4, 'F': 4, 'I;16': 2}
+
+
+def image_nbytes(image):
+    if image is None:
+        return 0
+    return image.width * image.height * len(image.getbands()) * MODE_BYTES.get(image.mode, 1)
+
+
+def entry_nbytes(entry):
+    ''' Resident size of a load_image result, i.e. every materialised pyramid level '''
+    image, sicd, pyramid = entry
+    levels = [level for level in pyramid.levels if level is not None]
+    overview = getattr(image, 'overview', None)
+    if overview is not None and all(level is not overview for level in levels):
+        levels.append(overview)
+    nbytes = sum(image_nbytes(level) for level in levels)
+    full = getattr(image, 'full', None)  # a PictureSource that already holds full resolution
+    if full is not None and not isinstance(full, np.memmap):
+        nbytes += full.nbytes
+    return nbytes
+
+
+class ImageCache:
+    ''' LRU cache of decoded, remapped images keyed by path and mtime, bounded in bytes '''
+
+    def __init__(self, loader, max_bytes=1 << 30, sizeof=entry_nbytes):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(path):
+        # a rewritten file gets a new mtime, so stale entries just age out
+        return os.path.abspath(path), os.stat(path).st_mtime_ns
+
+    def get(self, path):
+        ''' Cached entry for path, loading (outside the lock) and inserting it on a miss '''
+        key = self.key(path)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+        entry = self.loader(path)
+        self.put(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        if hasattr(entry[0], 'on_full'):
+            # sized under the lock, so full resolution loading meanwhile is counted here or by recharge
+            entry[0].on_full = lambda: self.recharge(key, entry)
+        with self.lock:
+            self._insert(key, entry)
+
+    def recharge(self, key, entry):
+        ''' Recount entry after it grew in place, e.g. a PictureSource that decoded its full resolution '''
+        with self.lock:
+            if key in self.entries and self.entries[key][0] is entry:
+                self._insert(key, entry)
+
+    def _insert(self, key, entry):
+        size = self.sizeof(entry)
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (entry, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def discard(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == path]:
+                self.nbytes -= self.entries.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes}
@@ -0,0 +1,74 @@
+import math
+from PIL import Image
+
+
+class ImagePyramid:
+    ''' Power-of-two reductions of an image, built once so redraws never resample the full image
+
+    image is either a PIL image or a lazy source (see image_sources) exposing an
+    overview at a power-of-two step. Levels finer than a lazy overview are left as
+    None and read window by window from the source at that level's stride, or
+    drawn from the overview while a source that is not ready yet loads.
+    '''
+
+    def __init__(self, image, min_size=256, levels=None):
+        self.image = image
+        self.width, self.height = image.size
+        overview = getattr(image, 'overview', None)
+        if levels is not None:
+            # previously built levels, e.g. memory maps from the on-disk remap cache
+            self.levels = list(levels)
+            return
+        if overview is None:
+            self.levels = [image]
+            level = image
+        else:
+            self.levels = [None] * int(math.log2(image.step)) + [overview]
+            level = overview
+        # keep halving until the next level would be smaller than min_size on its short side
+        while min(level.size) // 2 >= min_size:
+            level = self._reduce(level)
+            self.levels.append(level)
+
+    @staticmethod
+    def _reduce(image):
+        return ImagePyramid._reduce_by(image, 2)
+
+    @staticmethod
+    def _reduce_by(image, factor):
+        try:
+            return image.reduce(factor)
+        except ValueError:  # modes like "P" and "1" can not be box reduced
+            return image.convert('RGBA' if 'transparency' in image.info else 'RGB').reduce(factor)
+
+    def level_index(self, scale):
+        ''' Index of the coarsest level that still has at least one pixel per screen pixel '''
+        if scale >= 1:
+            return 0
+        index = int(math.floor(math.log2(1 / scale)))
+        return max(0, min(index, len(self.levels) - 1))
+
+    def crop(self, box, scale, size, fast=False):
+        ''' Resample box (full-resolution coordinates) to size from the level closest to scale
+
+        fast is the interaction preview: one level coarser and nearest neighbour,
+        a quarter of the pixels to read and no filtering.
+        '''
+        index = self.level_index(scale)
+        resample = {}
+        if fast:
+            index = min(index + 1, len(self.levels) - 1)
+            resample = {'resample': Image.NEAREST}
+        level = self.levels[index]
+        x1, y1, x2, y2 = box
+        if level is None:
+            if getattr(self.image, 'ready', True):
+                # only the visible window is read, decimated to this level's stride
+                return self.image.crop(box, step=2 ** index).resize(size, **resample)
+            # full resolution is still decoding in the background, upsample the preview meanwhile
+            self.image.request_full()
+            level = next(level for level in self.levels if level is not None)
+        # level sizes are floored at every halving, so use the exact per-axis ratio
+        fx = level.width / self.width
+        fy = level.height / self.height
+        return level.resize(size, box=(x1 * fx, y1 * fy, x2 * fx, y2 * fy), **resample)
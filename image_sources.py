@@ -0,0 +1,300 @@
+import os
+import abc
+import math
+import hashlib
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from sarpy.io.complex.sicd import SICDReader
+from sarpy.visualization.remap import Density
+from image_pyramid import ImagePyramid
+from remap_stream import RemapLUT, sample_data_mean
+from instrumentation import probe
+
+
+class RasterSource(abc.ABC):
+    ''' The backend interface every large displayed image goes through
+
+    Subclasses give size, an overview PIL image at a power-of-two step for the
+    ImagePyramid, and window(x1, y1, x2, y2, step), the 8-bit pixels of a box
+    inside the image at a stride. crop() builds PIL crops on top of window(),
+    so the canvas tiles, chips and grid exports only ever touch the pixels
+    they show or write, never a full in-memory raster.
+    '''
+
+    ready = True
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def request_full(self):
+        pass
+
+    @abc.abstractmethod
+    def window(self, x1, y1, x2, y2, step):
+        pass
+
+    def crop(self, box, step=1):
+        ''' 8-bit PIL image of box, padded with zeros outside the image like Image.crop '''
+        left, upper, right, lower = [int(v) for v in box]
+        out = None
+        x1, y1 = max(left, 0), max(upper, 0)
+        x2, y2 = min(right, self.width), min(lower, self.height)
+        if x2 > x1 and y2 > y1:
+            # start on the stride grid of the requested box so padding and data stay aligned
+            x1 += (left - x1) % step
+            y1 += (upper - y1) % step
+            window = self.window(x1, y1, x2, y2, step)
+            out = np.zeros((-(-(lower - upper) // step), -(-(right - left) // step)) + window.shape[2:], dtype=np.uint8)
+            oy, ox = (y1 - upper) // step, (x1 - left) // step
+            out[oy:oy + window.shape[0], ox:ox + window.shape[1]] = window
+        if out is None:
+            out = np.zeros((-(-(lower - upper) // step), -(-(right - left) // step)) + self.channels, dtype=np.uint8)
+        return Image.fromarray(out)
+
+
+class SICDImageSource(RasterSource):
+    ''' Lazily remapped view of a SICD file that stands in for the PIL image the app displays
+
+    Only a decimated overview is read up front. Everything else is read from the
+    reader window by window, so the full complex array is never held in memory.
+    '''
+
+    def __init__(self, reader, overview_size=2048, remap=None):
+        self.reader = reader
+        # the Tk, prefetch, remap cache and chip threads all read through one sarpy reader
+        self.lock = threading.Lock()
+        self.remap = remap if remap is not None else Density()
+        rows, cols = reader.data_size[:2]
+        self.width, self.height = cols, rows
+        # power-of-two stride so the overview lines up with an ImagePyramid level
+        longest = max(rows, cols)
+        self.step = 2 ** max(0, math.ceil(math.log2(longest / overview_size))) if longest > overview_size else 1
+        with probe.stage('sicd overview'):
+            overview = reader[::self.step, ::self.step]
+        probe.count('sicd bytes read', overview.nbytes)
+        # one global mean keeps every window remapped with the same brightness
+        self.data_mean = sample_data_mean(overview)
+        self._lut = None
+        self.overview = Image.fromarray(self.lut(overview))
+        self.remapped = None
+        self.channels = ()
+
+    @classmethod
+    def from_remapped(cls, reader, remapped, overview, step, data_mean, remap=None):
+        ''' Source backed by an already remapped 8-bit array (e.g. a memory map), skipping every read '''
+        self = cls.__new__(cls)
+        self.reader = reader
+        self.lock = threading.Lock()
+        self.remap = remap if remap is not None else Density()
+        self.height, self.width = remapped.shape[:2]
+        self.step = step
+        self.data_mean = data_mean
+        self.overview = overview
+        self.remapped = remapped
+        self._lut = None
+        self.channels = ()
+        return self
+
+    @property
+    def lut(self):
+        ''' RemapLUT for this image's data mean, built on first use '''
+        if self._lut is None:
+            self._lut = RemapLUT(self.remap, self.data_mean)
+        return self._lut
+
+    def read(self, box, step=1):
+        ''' Complex pixels inside box (left, upper, right, lower), clamped to the image '''
+        left, upper, right, lower = [int(v) for v in box]
+        left, upper = max(left, 0), max(upper, 0)
+        right, lower = min(right, self.width), min(lower, self.height)
+        with self.lock, probe.stage('sicd read'):
+            data = self.reader[upper:lower:step, left:right:step]
+        probe.count('sicd bytes read', data.nbytes)
+        return data
+
+    def window(self, x1, y1, x2, y2, step):
+        ''' Remapped 8-bit pixels, from the memory map when there is one '''
+        if self.remapped is not None:
+            return self.remapped[y1:y2:step, x1:x2:step]
+        data = self.read((x1, y1, x2, y2), step)
+        with probe.stage('remap'):
+            return self.lut(data)
+
+
+# full resolution pictures are decoded here, off the Tk and prefetch threads
+_full_loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fullres')
+
+
+def preview_step(width, height, overview_size):
+    ''' Power-of-two reduction that brings the longest side to at most overview_size '''
+    longest = max(width, height)
+    return 2 ** max(0, math.ceil(math.log2(longest / overview_size))) if longest > overview_size else 1
+
+
+def picture_cache_paths(cache_dir, file_path, overview_size):
+    ''' (preview PNG, full resolution .npy raster) kept for file_path in cache_dir '''
+    stat = os.stat(file_path)
+    key = hashlib.sha1(f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}|{overview_size}".encode()).hexdigest()[:16]
+    stem = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(file_path))[0]}_{key}")
+    return stem + ".png", stem + ".npy"
+
+
+def raster_image(image):
+    ''' image in a mode that maps onto an 8-bit (rows, cols[, bands]) array '''
+    if image.mode in ('L', 'RGB', 'RGBA'):
+        return image
+    return image.convert('RGBA' if image.mode in ('LA', 'PA') or 'transparency' in image.info else 'RGB')
+
+
+class PictureSource(RasterSource):
+    ''' A large JPEG/PNG shown from a reduced preview until full resolution is needed
+
+    JPEGs are previewed with draft mode, which decodes straight to 1/2, 1/4 or
+    1/8 scale. Other formats need one full decode to build a preview, so
+    without a cache_dir to keep it in they are opened whole like small
+    pictures. Full resolution is decoded on a background thread once
+    request_full() is called, i.e. once the view zooms past the preview, and
+    crop() waits for it so chipping and exports see full resolution pixels.
+    With a cache_dir, the preview and the full raster are kept there, the
+    raster as a .npy memory map, so later opens neither decode nor hold the
+    picture in memory. on_full, when set, is called once full is loaded.
+    '''
+
+    def __init__(self, file_path, size, overview, full=None, raster_path=None):
+        self.file_path = file_path
+        self.width, self.height = size
+        self.overview = raster_image(overview)
+        self.channels = () if self.overview.mode == 'L' else (len(self.overview.getbands()),)
+        # the overview may be a little larger than size / step when the decoder rounds up
+        self.step = 2 ** round(math.log2(self.width / overview.width))
+        self.full = full
+        self.raster_path = raster_path
+        self.future = None
+        self.lock = threading.Lock()
+        self.on_full = None
+
+    @classmethod
+    def open(cls, file_path, overview_size=2048, cache_dir=None):
+        ''' A PictureSource for file_path, previewed from a reduced overview when it is larger than overview_size '''
+        image = Image.open(file_path)
+        size = image.size
+        step = preview_step(*size, overview_size)
+        if step == 1:
+            # small enough to decode whole, the decoded picture is both the overview and the raster
+            image.load()
+            return cls(file_path, size, image)
+        preview_file, raster_path = picture_cache_paths(cache_dir, file_path, overview_size) if cache_dir else (None, None)
+        if preview_file and os.path.isfile(preview_file):
+            overview = Image.open(preview_file)
+            overview.load()
+            full = np.load(raster_path, mmap_mode='r') if os.path.isfile(raster_path) else None
+            return cls(file_path, size, overview, full=full, raster_path=raster_path)
+        if image.format == 'JPEG':
+            image.draft(image.mode, (math.ceil(size[0] / step), math.ceil(size[1] / step)))
+            if image.size != size:
+                image.load()
+                source = cls(file_path, size, image, raster_path=raster_path)
+                if preview_file:
+                    source.save_preview(preview_file)
+                return source
+        image.load()
+        if preview_file is None:
+            # decoded whole anyway with nowhere to cache it, so show it whole like a small picture
+            return cls(file_path, size, image)
+        image = raster_image(image)
+        source = cls(file_path, size, ImagePyramid._reduce_by(image, step), raster_path=raster_path)
+        if preview_file:
+            source.save_preview(preview_file)
+        # already decoded, so keep it rather than decode it again on the first zoom
+        source.full = source.store_raster(image)
+        return source
+
+    def save_preview(self, preview_file):
+        os.makedirs(os.path.dirname(preview_file), exist_ok=True)
+        self.overview.save(preview_file + ".tmp.png")
+        os.replace(preview_file + ".tmp.png", preview_file)
+
+    def store_raster(self, image):
+        ''' The decoded picture as an array, moved into a memory map when there is a raster_path '''
+        array = np.asarray(image)
+        if self.raster_path is None:
+            return array
+        # unique per writer, grid chip workers may store the same picture at once
+        tmp_path = f"{self.raster_path[:-4]}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=array.shape)
+        out[:] = array
+        out.flush()
+        del out, array
+        os.replace(tmp_path, self.raster_path)
+        return np.load(self.raster_path, mmap_mode='r')
+
+    @property
+    def ready(self):
+        return self.full is not None or self.step == 1
+
+    @property
+    def loading(self):
+        return self.future is not None and not self.future.done()
+
+    def _load_full(self):
+        image = Image.open(self.file_path)
+        image.load()
+        self.full = self.store_raster(raster_image(image))
+        if self.on_full is not None:
+            self.on_full()
+        return self.full
+
+    def request_full(self):
+        ''' Start decoding full resolution in the background, once '''
+        with self.lock:
+            if self.full is None and self.future is None:
+                self.future = _full_loader.submit(self._load_full)
+            return self.future
+
+    def full_array(self):
+        if self.full is not None:
+            return self.full
+        if self.step == 1:
+            # the overview is the whole picture, its array is only made for the first chip or export
+            with self.lock:
+                if self.full is None:
+                    self.full = np.asarray(self.overview)
+                    if self.on_full is not None:
+                        self.on_full()
+            return self.full
+        future = self.request_full()
+        return future.result() if future is not None else self.full
+
+    def load(self):
+        self.full_array()
+
+    def window(self, x1, y1, x2, y2, step):
+        return self.full_array()[y1:y2:step, x1:x2:step]
+
+
+def load_image(file_path, remap=None, disk_cache=None, picture_cache_dir=None):
+    ''' Open file_path for display, returning (image, SICD reader or None, pyramid)
+
+    Safe to call off the Tk thread, which is how the prefetcher uses it. With a
+    RemapDiskCache, SICD files open from their memory-mapped remap when it is
+    still valid and are queued for caching when it is not. Pictures larger than
+    the overview open as a PictureSource preview, cached in picture_cache_dir if given.
+    '''
+    if file_path.endswith(('.ntf', '.nitf')):
+        sicd = SICDReader(file_path)
+        remap = remap if remap is not None else Density()
+        if disk_cache is not None:
+            cached = disk_cache.open(file_path, sicd, remap)
+            if cached is not None:
+                image, pyramid = cached
+                return image, sicd, pyramid
+        image = SICDImageSource(sicd, remap=remap)
+        pyramid = ImagePyramid(image)
+        if disk_cache is not None:
+            disk_cache.submit(file_path, image, pyramid)
+        return image, sicd, pyramid
+    image = PictureSource.open(file_path, cache_dir=picture_cache_dir)
+    return image, None, ImagePyramid(image)
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import threading
+import functools
+from collections import deque, defaultdict
+from contextlib import contextmanager, nullcontext
+import numpy as np
+
+
+class Instrumentation:
+    ''' Opt-in stage timings and byte counters for the app's hot paths
+
+    Disabled, stage() is a shared no-op context, so the probes can stay in the
+    code. Enabled, every stage keeps its last window durations for rolling
+    percentiles and appends a complete event to a bounded trace that dump()
+    writes in the Chrome trace event format (chrome://tracing, Perfetto).
+    Safe to use from the prefetch and export threads.
+    '''
+
+    def __init__(self, enabled=False, window=200, max_events=100000):
+        self.enabled = enabled
+        self.window = window
+        self.durations = defaultdict(lambda: deque(maxlen=self.window))
+        self.counters = defaultdict(int)
+        self.events = deque(maxlen=max_events)
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self._off = nullcontext()
+
+    def stage(self, name):
+        if not self.enabled:
+            return self._off
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start)
+
+    def record(self, name, start, seconds):
+        with self.lock:
+            self.durations[name].append(seconds)
+            self.events.append((name, start - self.origin, seconds, threading.get_ident()))
+
+    def count(self, name, nbytes):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += int(nbytes)
+
+    def wrap(self, name, fn):
+        ''' fn timed as stage name wherever it ends up running, e.g. on the export writer '''
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return timed
+
+    def timed(self, name):
+        ''' Decorator form of wrap for methods '''
+        return functools.partial(self.wrap, name)
+
+    def percentiles(self, name, q=(50, 90, 99)):
+        with self.lock:
+            durations = list(self.durations[name])
+        if not durations:
+            return None
+        return np.percentile(durations, q)
+
+    def summary(self):
+        ''' Text table of the rolling percentiles, in milliseconds, and the byte counters '''
+        lines = [f"{'stage':<18}{'n':>6}{'p50':>9}{'p90':>9}{'p99':>9}"]
+        with self.lock:
+            names = sorted(self.durations)
+            counts = {name: len(self.durations[name]) for name in names}
+            counters = dict(self.counters)
+        for name in names:
+            p = self.percentiles(name)
+            if p is not None:
+                lines.append(f"{name:<18}{counts[name]:>6}{p[0] * 1e3:>9.1f}{p[1] * 1e3:>9.1f}{p[2] * 1e3:>9.1f}")
+        for name, nbytes in sorted(counters.items()):
+            lines.append(f"{name:<18}{nbytes / (1 << 20):>15.1f} MB")
+        return "\n".join(lines)
+
+    def dump(self, path):
+        ''' Write the trace and counters as Chrome trace event JSON '''
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+            counters = dict(self.counters)
+        trace = [{'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': seconds * 1e6, 'pid': pid, 'tid': tid}
+                 for name, start, seconds, tid in events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'otherData': {'counters': counters}}, f)
+
+    def reset(self):
+        with self.lock:
+            self.durations.clear()
+            self.counters.clear()
+            self.events.clear()
+
+
+# one instance shared by the app and the loaders it calls
+probe = Instrumentation()
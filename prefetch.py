@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ImagePrefetcher:
+    ''' Decodes the images around the current index on worker threads
+
+    loader(path) does the decode and remap and must not touch Tk. Results are
+    kept while their path stays inside the prefetch window, so stepping to a
+    neighbour is normally a finished future rather than a synchronous load.
+    '''
+
+    def __init__(self, loader, radius=2, workers=2):
+        self.loader = loader
+        self.radius = radius
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self.futures = {}
+        self.direction = 1
+
+    def get(self, path):
+        ''' Result for path, waiting on in-flight work instead of decoding it twice '''
+        future = self.futures.get(path)
+        if future is None or future.cancelled():
+            return self.loader(path)
+        try:
+            return future.result()
+        except Exception:
+            # a failed background load is retried on this thread so the error surfaces normally
+            self.futures.pop(path, None)
+            return self.loader(path)
+
+    def window(self, paths, index, direction):
+        ''' Paths to keep warm, nearest first and in the direction of travel first '''
+        order = []
+        for step in range(1, self.radius + 1):
+            for sign in (direction, -direction):
+                path = paths[(index + sign * step) % len(paths)]
+                if path not in order:
+                    order.append(path)
+        return order
+
+    def schedule(self, paths, index, direction=1):
+        if not paths or self.radius <= 0:
+            return
+        direction = 1 if direction >= 0 else -1
+        wanted = self.window(paths, index, direction)
+        keep = set(wanted)
+        keep.add(paths[index])
+        for path in list(self.futures):
+            # queued work is resubmitted in the new order when the direction flips
+            if path not in keep or (direction != self.direction and self.futures[path].cancel()):
+                self.futures.pop(path).cancel()
+        self.direction = direction
+        for path in wanted:
+            if path not in self.futures:
+                self.futures[path] = self.executor.submit(self.loader, path)
+
+    def close(self):
+        self.futures.clear()
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from image_pyramid import ImagePyramid
+from image_sources import SICDImageSource
+from remap_stream import remap_blocks
+
+
+class RemapDiskCache:
+    ''' Sidecar directory of remapped 8-bit SICD images and pyramid levels stored as .npy memory maps
+
+    An entry is only used while the source file's size, mtime and SICD metadata
+    hash (and the remap settings) still match what was recorded when it was
+    written. meta.json is written last, so a half-written entry never validates.
+    '''
+
+    def __init__(self, cache_dir, band_bytes=32 << 20, workers=None):
+        self.cache_dir = cache_dir
+        self.band_bytes = band_bytes
+        self.workers = workers
+        os.makedirs(cache_dir, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='remap-cache')
+        self.pending = set()
+
+    def entry_dir(self, file_path):
+        file_path = os.path.abspath(file_path)
+        stem = os.path.splitext(os.path.basename(file_path))[0]
+        return os.path.join(self.cache_dir, f"{stem}_{hashlib.sha1(file_path.encode()).hexdigest()[:12]}")
+
+    @staticmethod
+    def signature(file_path, reader, remap):
+        stat = os.stat(file_path)
+        return {'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'sicd_sha1': hashlib.sha1(reader.sicd_meta.to_xml_bytes()).hexdigest(),
+                'remap': [type(remap).__name__, remap.dmin, remap.mmult, remap.max_output_value]}
+
+    def open(self, file_path, reader, remap):
+        ''' (image source, pyramid) memory-mapped from a valid entry, or None '''
+        entry = self.entry_dir(file_path)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get('signature') != self.signature(file_path, reader, remap):
+            return None
+        try:
+            remapped = np.load(os.path.join(entry, 'image.npy'), mmap_mode='r')
+            levels = [None if index is None else Image.fromarray(np.load(os.path.join(entry, f'level_{index}.npy'), mmap_mode='r'))
+                      for index in meta['levels']]
+        except (OSError, ValueError):
+            return None
+        overview = levels[int(np.log2(meta['step']))]
+        image = SICDImageSource.from_remapped(reader, remapped, overview, meta['step'], meta['data_mean'], remap=remap)
+        return image, ImagePyramid(image, levels=levels)
+
+    def store(self, file_path, image, pyramid):
+        ''' Remap the full image block by block into a memory map and save the pyramid levels '''
+        entry = self.entry_dir(file_path)
+        os.makedirs(entry, exist_ok=True)
+        meta_path = os.path.join(entry, 'meta.json')
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+        tmp_path = os.path.join(entry, 'image.tmp.npy')
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(image.height, image.width))
+        remap_blocks(lambda upper, lower: image.read((0, upper, image.width, lower)),
+                     (image.height, image.width), image.lut, out=out, block_bytes=self.band_bytes, workers=self.workers)
+        out.flush()
+        del out
+        os.replace(tmp_path, os.path.join(entry, 'image.npy'))
+        levels = []
+        for index, level in enumerate(pyramid.levels):
+            if level is None:
+                levels.append(None)
+                continue
+            np.save(os.path.join(entry, f'level_{index}.npy'), np.asarray(level))
+            levels.append(index)
+        meta = {'source': os.path.abspath(file_path),
+                'signature': self.signature(file_path, image.reader, image.remap),
+                'step': image.step,
+                'data_mean': image.data_mean,
+                'levels': levels}
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f, indent=1)
+
+    def submit(self, file_path, image, pyramid):
+        ''' Queue store() on the background writer, once per file '''
+        key = os.path.abspath(file_path)
+        if key in self.pending:
+            return None
+        self.pending.add(key)
+        future = self.executor.submit(self.store, file_path, image, pyramid)
+
+        def done(future):
+            self.pending.discard(key)
+            if not future.cancelled() and future.exception() is not None:
+                print(f"Remap cache write failed for {file_path}: {future.exception()}")
+        future.add_done_callback(done)
+        return future
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -0,0 +1,66 @@
+import math
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def subsample_data_mean(reader, max_samples=1 << 22):
+    ''' Mean amplitude estimated from a strided subsample of at most max_samples pixels '''
+    rows, cols = reader.data_size[:2]
+    step = max(1, math.ceil(math.sqrt(rows * cols / max_samples)))
+    return sample_data_mean(reader[::step, ::step])
+
+
+def sample_data_mean(sample):
+    amplitude = np.abs(sample)
+    return float(np.mean(amplitude[np.isfinite(amplitude)]))
+
+
+class RemapLUT:
+    ''' A sarpy remap with a fixed data mean, applied as a lookup on quantised pixel power
+
+    |z|^2 is bucketed by the top bits of its float32 representation (exponent plus
+    the leading mantissa bits), i.e. logarithmically like the Density curve
+    itself. The table holds the remap of every bucket centre, so a block costs
+    one multiply-add and one gather instead of abs, log10 and float temporaries.
+    With the default 12 mantissa bits, pixels differ from remap() by at most one
+    grey level, and only right at level boundaries.
+    '''
+
+    def __init__(self, remap, data_mean, mantissa_bits=12):
+        self.shift = 23 - mantissa_bits
+        # only finite powers are remapped, exponent 255 holds the Inf and NaN patterns
+        buckets = np.arange(255 << mantissa_bits, dtype=np.uint32)
+        centres = ((buckets << self.shift) + (1 << (self.shift - 1))).view(np.float32)
+        amplitude = np.sqrt(centres.astype(np.float64)).astype(np.complex64)
+        finite = remap(amplitude, data_mean=data_mean)
+        self.table = np.zeros(1 << (31 - self.shift), dtype=finite.dtype)  # non-finite pixels come out black
+        self.table[:len(finite)] = finite
+        self.dtype = self.table.dtype
+
+    def __call__(self, data, out=None):
+        power = np.square(data.real)
+        power += np.square(data.imag)
+        index = power.astype(np.float32, copy=False).view(np.int32) >> self.shift
+        return np.take(self.table, index, out=out)
+
+
+def remap_blocks(read, shape, lut, out=None, block_rows=None, block_bytes=32 << 20, workers=None):
+    ''' Remap a (rows, cols) complex image into a preallocated output one row block at a time
+
+    read(upper, lower) returns the complex rows [upper, lower). Blocks are spread
+    over a thread pool, so peak memory is the output plus one block per worker.
+    '''
+    rows, cols = shape
+    if out is None:
+        out = np.empty((rows, cols), dtype=lut.dtype)
+    if block_rows is None:
+        block_rows = max(1, block_bytes // (cols * 8))
+
+    def work(upper):
+        lower = min(upper + block_rows, rows)
+        lut(read(upper, lower), out=out[upper:lower])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the first worker error here
+        list(executor.map(work, range(0, rows, block_rows)))
+    return out
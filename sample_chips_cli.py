@@ -0,0 +1,85 @@
+''' Training chips sampled around the YOLO labels of a directory tree
+
+For every image below a directory with a YOLO .txt label file next to it (the
+Export Rectangles TXT format), writes fixed-size chips centred on, or jittered
+around, each labelled box plus a ratio of random negatives that touch no box,
+with the labels rewritten into chip coordinates. Chips go to the images/ and
+labels/ folders YOLO trainers read, or into tar shards with --shards. Sampling
+is seeded per image, so a rerun writes the same chips.
+
+    python sample_chips_cli.py /data/scenes /data/train --chip-size 512 --jitter 0.5 --negatives 1 --png
+'''
+import os
+import sys
+import zlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from annotations import read_yolo, chip_yolo, yolo_path
+from chip_export import sample_plan, export_samples
+from chip_archive import SHARD_BYTES, shard_prefix
+from grid_chip_cli import find_images, image_size, SAR_EXTENSIONS, PICTURE_EXTENSIONS
+
+
+def sample_file(file_path, args):
+    ''' Sample one labelled image in this process, returning (file_path, positives, negatives, bad label lines) '''
+    width, height = image_size(file_path)
+    labels, coords, bad = read_yolo(yolo_path(file_path), width, height)
+    rng = np.random.default_rng([args.seed, zlib.crc32(os.path.abspath(file_path).encode())])
+    plan = sample_plan(width, height, coords, args.chip_size, args.per_box, args.jitter, args.negatives, rng)
+    prefix = shard_prefix(file_path)
+    samples = []
+    for k, (positive, box) in enumerate(plan):
+        chip_labels, rows = chip_yolo(labels, coords, box, args.min_visible)
+        samples.append((f"{prefix}_{'pos' if positive else 'neg'}{k:05d}", box, chip_labels, rows))
+    export_samples(file_path, samples, args.output, png=args.png, npy=args.npy,
+                   npy_kind='amplitude' if args.amplitude else 'complex',
+                   shard_dir=args.output if args.shards else None, shard_bytes=args.shard_mb << 20)
+    positives = sum(positive for positive, _ in plan)
+    return file_path, positives, len(plan) - positives, bad
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sample training chips around the YOLO labels below a directory.")
+    parser.add_argument('directory')
+    parser.add_argument('output', help='where images/, labels/ and npys/ (or the shards) are written')
+    parser.add_argument('-c', '--chip-size', type=int, default=512, help='chip size in pixels')
+    parser.add_argument('--per-box', type=int, default=1, help='positive chips per labelled box')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='0 centres chips on their box, up to 1 shifts them at random while the box still fits')
+    parser.add_argument('--negatives', type=float, default=0.0, help='random chips touching no box, per positive chip')
+    parser.add_argument('--min-visible', type=float, default=0.5,
+                        help='fraction of a box that must be inside a chip for it to be labelled there')
+    parser.add_argument('--png', action='store_true', help='write chips as PNGs, SICDs remapped like the app shows them')
+    parser.add_argument('--npy', action='store_true', help='write .npy chips, complex for SICD inputs')
+    parser.add_argument('--amplitude', action='store_true', help='save the float32 amplitude of SICDs to .npy instead')
+    parser.add_argument('--shards', action='store_true', help='write tar shards to the output directory instead')
+    parser.add_argument('--shard-mb', type=int, default=SHARD_BYTES >> 20, help='size cap of one shard in MB')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-w', '--workers', type=int, default=None, help='processes, default every core')
+    parser.add_argument('--sar-only', action='store_true', help='ignore jpg/jpeg/png inputs')
+    args = parser.parse_args(argv)
+    if not (args.png or args.npy):
+        parser.error('nothing to write, pass --png and/or --npy')
+
+    extensions = SAR_EXTENSIONS if args.sar_only else SAR_EXTENSIONS + PICTURE_EXTENSIONS
+    paths = [path for path in find_images(args.directory, extensions) if os.path.isfile(yolo_path(path))]
+    print(f"{len(paths)} labelled images under {args.directory}")
+    failures = 0
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+        futures = {executor.submit(sample_file, path, args): path for path in paths}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                file_path, positives, negatives, bad = future.result()
+                note = f", skipped label lines {bad}" if bad else ""
+                print(f"[{done}/{len(paths)}] {file_path}: {positives} positive, {negatives} negative chips{note}")
+            except Exception as e:
+                failures += 1
+                print(f"[{done}/{len(paths)}] {futures[future]}: failed, {e}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())